@@ -0,0 +1,37 @@
+"""
+Benchmark the drive crawl (graph.list_drive_files) against the local fake graph server.
+
+    python -m benchmarks.bench_graph_crawl --folders 5000 --files-per-folder 10 --latency 0.01 --workers 1,8,32
+"""
+import argparse
+import logging
+import time
+
+from fakes.graph import FakeGraph, FakeGraphServer
+from util import graph
+
+
+def main():
+    """Crawl the same synthetic drive with each of the requested worker counts"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folders", type=int, default=5000)
+    parser.add_argument("--files-per-folder", type=int, default=10)
+    parser.add_argument("--fanout", type=int, default=10, help="sub folders per folder")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to every graph request")
+    parser.add_argument("--workers", default="1,8,32", help="comma separated list of concurrency to compare")
+    args = parser.parse_args()
+    logging.getLogger("util.graph").setLevel(logging.WARNING)
+
+    fake = FakeGraph(args.folders, args.files_per_folder, args.fanout)
+    with FakeGraphServer(fake, latency=args.latency) as server:
+        url = f"{server.endpoint}/drives/{fake.drive_id}/root/children"
+        print(f"{'workers':>8} {'files':>8} {'seconds':>9} {'files/s':>9}")
+        for workers in (int(w) for w in args.workers.split(",")):
+            started = time.perf_counter()
+            files = graph.list_drive_files(url, "token", workers)
+            elapsed = time.perf_counter() - started
+            print(f"{workers:>8} {len(files):>8} {elapsed:>9.2f} {len(files) / elapsed:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+"""
+End to end benchmark of an indexing run: the `start` orchestrator of function_app driven by a local durable runtime,
+against local stand-ins for Graph (listings and downloads), Azure AI Search and Azure OpenAI.
+
+    python -m benchmarks.bench_pipeline --folders 20 --files-per-folder 10 --latency 0.01 --json results.json
+
+Reports files/s, latency percentiles per stage (each activity, plus the download/parse and embed/upload steps of
+index_files) and the peak RSS. Save the results with --json to compare versions. The first of the --runs pays for
+loading the libraries (cold start), the next ones index into a new index unless --incremental is passed (then nothing
+changed and only the freshness check has work to do). --update-files edits the end of that many files before each run
+but the first, with --embedding-cache sqlite their unchanged chunks are then not embedded again (see the cache hits).
+--add-files and --delete-files change the drive too, the changes falling in the indexed --folder are reported next to
+what the run picked up (--delta runs only get the changes from graph). With --sites the drive is indexed as that many
+sites by a single batch orchestration (start_batch).
+
+    python -m benchmarks.bench_pipeline --runs 2 --incremental --delta --folder "Folder 0" --add-files 20 \
+        --delete-files 20 --update-files 20
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+from azure.core.credentials import AccessToken
+
+from fakes.graph import FakeGraph, FakeGraphServer
+from fakes.openai import FakeOpenAI, FakeOpenAIServer
+from fakes.search import FakeSearch, FakeSearchServer
+from fakes.storage import FakeContainerClient
+
+from .durable import LocalDurableRuntime
+
+_PERCENTILES = (50, 90, 99)
+
+
+class _FakeCredential:
+    """Stands in for the managed identity, the fake graph doesn't check tokens"""
+    def get_token(self, *_, **__):
+        """Token valid for an hour"""
+        return AccessToken("fake-token", int(time.time()) + 3600)
+
+    async def close(self):
+        """Nothing to close"""
+
+
+def _percentile(values: list[float], percent: int):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+
+def _stage_stats(timings: dict):
+    return {stage: {"count": len(values),
+                    "total": round(sum(values), 3),
+                    **{f"p{percent}": round(_percentile(values, percent), 4) for percent in _PERCENTILES},
+                    "max": round(max(values), 4)}
+            for stage, values in timings.items() if values}
+
+
+def _timed(timings: dict, lock: threading.Lock, stage: str, function):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            with lock:
+                timings[stage].append(time.perf_counter() - started)
+    return wrapper
+
+
+def _delta(after: dict, before: dict):
+    """Counters of this run out of the cumulative ones (the current rates are kept as is)"""
+    return {key: _delta(value, before.get(key, {})) if isinstance(value, dict)
+            else value if key == "rate" else round(value - before.get(key, 0), 3)
+            for key, value in after.items()}
+
+
+def _counters(servers: dict, fake_openai: FakeOpenAI, throttle, embeddings_cache):
+    return {"throttle": throttle.stats(),
+            "servers": {name: {"requests": server.requests, "throttled": server.throttled}
+                        for name, server in servers.items()},
+            "embedded": {"inputs": fake_openai.inputs, "tokens": fake_openai.tokens},
+            "embedding_cache": embeddings_cache.stats() if embeddings_cache else {}}
+
+
+def _run(runtime: LocalDurableRuntime, args: argparse.Namespace, drive_name: str, run: int):
+    """Index the drive (as --sites sites) with the start/start_batch orchestrator, returns its output"""
+    site_name = "benchmark" if args.incremental else f"benchmark{run}"
+    if args.folder:
+        drive_name = f"{drive_name}/{args.folder}"
+    if args.sites > 1:
+        # every site name is resolved to the same fake drive, each one being indexed in its own index.
+        return runtime.run("start_batch", {
+            "targets": [{"site_name": f"{site_name}-{i}", "drive_name": drive_name, "delta": args.delta}
+                        for i in range(args.sites)],
+            "run_id": f"benchmark-{run}", "max_sites": args.max_sites, "max_concurrency": args.max_concurrency,
+            "batch_size": args.batch_size})
+    return runtime.run("start", {"site_name": site_name, "drive_name": drive_name,
+                                 "run_id": f"benchmark-{run}", "max_concurrency": args.max_concurrency,
+                                 "batch_size": args.batch_size, "delta": args.delta})
+
+
+def _spread(values: list, count: int):
+    """`count` values taken evenly across the list"""
+    return values[::max(1, len(values) // count)][:count] if count else []
+
+
+def _change_files(fake_graph: FakeGraph, args: argparse.Namespace, run: int):
+    """
+    Edit, add and delete files across the whole drive (the --folder and out of it) before a run. Returns the number
+    of each change within the indexed folder, what the run is expected to pick up.
+    """
+    # the freshness check compares timestamps to the second.
+    time.sleep(1)
+    files = [item["id"] for item in fake_graph.delta() if "file" in item]
+    folders = ["root"] + [item["id"] for item in fake_graph.delta() if "folder" in item and item["id"] != "root"]
+    scope = set(fake_graph.subtree(_folder_id(fake_graph, args.folder)))
+    updated = _spread(files, args.update_files)
+    deleted = _spread([item_id for item_id in files if item_id not in updated], args.delete_files)
+    for item_id in updated:
+        fake_graph.update_file(item_id)
+    for item_id in deleted:
+        fake_graph.delete_item(item_id)
+    added = [fake_graph.add_file(parent, f"added-{run}-{i}.txt")["id"]
+             for i, parent in enumerate(folders[i % len(folders)] for i in range(args.add_files))]
+    scope |= set(added) & set(fake_graph.subtree(_folder_id(fake_graph, args.folder)))
+    return {"updated": len(scope.intersection(updated)), "added": len(scope.intersection(added)),
+            "deleted": len(scope.intersection(deleted))}
+
+
+def _folder_id(fake_graph: FakeGraph, name: str):
+    """Id of the folder of the drive having that name (the root if None)"""
+    if not name:
+        return "root"
+    return next(item["id"] for item in fake_graph.delta() if "folder" in item and item["name"] == name)
+
+
+def _version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KB on linux, the parsing processes are accounted as children.
+    return {"self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)}
+
+
+def _print_report(report: dict):
+    print(f"run {report['run']}: {report['files']} file(s) indexed out of {report['crawled']} in "
+          f"{report['seconds']:.2f}s -> {report['files_per_second']:.1f} files/s, "
+          f"peak RSS {report['peak_rss_mb']['self']}MB (parsing processes {report['peak_rss_mb']['children']}MB)")
+    print(f"  {'stage':<26} {'count':>6} {'total':>9} " + " ".join(f"{f'p{p}':>8}" for p in _PERCENTILES)
+          + f" {'max':>8}")
+    for stage, stats in report["stages"].items():
+        print(f"  {stage:<26} {stats['count']:>6} {stats['total']:>9.3f} "
+              + " ".join(f"{stats[f'p{p}']:>8.4f}" for p in _PERCENTILES) + f" {stats['max']:>8.4f}")
+    print(f"  throttling: {report['throttle']}")
+    print(f"  servers: {report['servers']}")
+    print(f"  embedded: {report['embedded']}, cache: {report['embedding_cache']}")
+    if report["changes"]:
+        print(f"  changes in scope: {report['changes']}, picked up: {report['summary']['files']}")
+    print(f"  run summary: {json.dumps(report['summary'])}")
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--folders", type=int, default=20)
+    parser.add_argument("--files-per-folder", type=int, default=10)
+    parser.add_argument("--fanout", type=int, default=10, help="sub folders per folder")
+    parser.add_argument("--file-size", type=int, default=4096, help="bytes per file")
+    parser.add_argument("--distinct-files", type=int, default=0,
+                        help="distinct contents, the other files are copies of them (0: all distinct)")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds added to every request of every server")
+    parser.add_argument("--graph-latency", type=float, help="overrides --latency for graph")
+    parser.add_argument("--search-latency", type=float, help="overrides --latency for search")
+    parser.add_argument("--openai-latency", type=float, help="overrides --latency for openai")
+    parser.add_argument("--throttle-every", type=int, default=0, help="every n-th request of a server is a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of the 429s, in seconds")
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--max-concurrency", type=int, default=10)
+    parser.add_argument("--max-activities", type=int, default=10 * (os.cpu_count() or 1),
+                        help="activities running at once (maxConcurrentActivityFunctions)")
+    parser.add_argument("--embedding-cache", default="none", choices=["none", "sqlite"])
+    parser.add_argument("--manifest-page-size", type=int, default=1000, help="files per page of the run manifest")
+    parser.add_argument("--sites", type=int, default=1, help="sites indexed by a single batch (start_batch)")
+    parser.add_argument("--max-sites", type=int, default=4, help="sites of a batch indexed at once")
+    parser.add_argument("--runs", type=int, default=1, help="runs against the same drive")
+    parser.add_argument("--incremental", action="store_true", help="re-use the index of the previous run")
+    parser.add_argument("--delta", action="store_true", help="delta runs (the first one enumerates the drive)")
+    parser.add_argument("--folder", help="only index this folder of the drive (i.e. 'Folder 0')")
+    parser.add_argument("--update-files", type=int, default=0,
+                        help="files edited (their last line) before each run but the first, across the drive")
+    parser.add_argument("--add-files", type=int, default=0, help="files added before each run but the first")
+    parser.add_argument("--delete-files", type=int, default=0, help="files deleted before each run but the first")
+    parser.add_argument("--json", help="write the results to this file")
+    return parser.parse_args()
+
+
+def main(): # pylint: disable=too-many-locals
+    """Start the stand-ins, point the function app to them and run the orchestration"""
+    args = _parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    fake_graph = FakeGraph(args.folders, args.files_per_folder, args.fanout, file_size=args.file_size,
+                           distinct_files=args.distinct_files)
+    fake_search = FakeSearch()
+    fake_openai = FakeOpenAI()
+    latency = lambda value: args.latency if value is None else value # pylint: disable=unnecessary-lambda-assignment
+    throttling = {"throttle_every": args.throttle_every, "retry_after": args.retry_after}
+
+    with ExitStack() as stack:
+        graph_server = stack.enter_context(FakeGraphServer(fake_graph, latency=latency(args.graph_latency),
+                                                           **throttling))
+        search_server = stack.enter_context(FakeSearchServer(fake_search, latency=latency(args.search_latency),
+                                                             **throttling))
+        openai_server = stack.enter_context(FakeOpenAIServer(fake_openai, latency=latency(args.openai_latency),
+                                                             **throttling))
+        # the settings are read when the modules are imported.
+        os.environ.update({
+            "GRAPH_API_ENDPOINT": graph_server.endpoint,
+            "AZURE_SEARCH_SERVICE_ENDPOINT": search_server.endpoint,
+            "REQUESTS_CA_BUNDLE": search_server.certificate,
+            "AZURE_SEARCH_ADMIN_KEY": "fake-key",
+            "AZURE_OPENAI_ENDPOINT": openai_server.endpoint,
+            "AZURE_OPENAI_API_KEY": "fake-key",
+            "EMBEDDING_CACHE": args.embedding_cache,
+            # a cache of its own, not the one left by a previous benchmark.
+            "EMBEDDING_CACHE_PATH": os.path.join(tempfile.mkdtemp(prefix="bench-"), "embeddings.db"),
+            "MANIFEST_PAGE_SIZE": str(args.manifest_page_size),
+        })
+        # pylint: disable=import-outside-toplevel
+        import function_app
+        from util import azure, storage, throttle
+        for name in list(logging.root.manager.loggerDict):
+            if name.split(".")[0] in ("util", "function_app", "httpx", "azure", "llama_index"):
+                logging.getLogger(name).setLevel(logging.ERROR)
+        # pylint: disable=protected-access
+        function_app._get_credential = _FakeCredential
+        container = FakeContainerClient()
+        storage._get_container_client = lambda: container
+        load_documents = function_app._load_documents
+        update_index = azure.update_index_with_documents
+        embeddings_cache = azure.get_embed_model().embeddings_cache
+
+        reports = []
+        servers = {"graph": graph_server, "search": search_server, "openai": openai_server}
+        runtime = LocalDurableRuntime(function_app, args.max_activities)
+        for run in range(1, args.runs + 1):
+            changes = _change_files(fake_graph, args, run) if run > 1 else {}
+            runtime.timings.clear()
+            lock = threading.Lock()
+            timings = defaultdict(list)
+            # the download/parse and embed/upload steps of index_files
+            function_app._load_documents = _timed(timings, lock, "index_files/download+parse", load_documents)
+            azure.update_index_with_documents = _timed(timings, lock, "index_files/embed+upload", update_index)
+            counters = _counters(servers, fake_openai, throttle, embeddings_cache)
+            started = time.perf_counter()
+            output = _run(runtime, args, fake_graph.drive_name, run)
+            elapsed = time.perf_counter() - started
+            timings.update(runtime.timings)
+            indexed = output["summary"]["files"]["indexed"]
+            report = {
+                "run": run,
+                "crawled": output["summary"]["files"]["crawled"],
+                "changes": changes,
+                "files": indexed,
+                "failed": output["summary"]["files"]["failed"],
+                "seconds": round(elapsed, 3),
+                "files_per_second": round(indexed / elapsed, 2),
+                "stages": _stage_stats(timings),
+                "peak_rss_mb": _peak_rss_mb(),
+                "summary": output["summary"],
+                **_delta(_counters(servers, fake_openai, throttle, embeddings_cache), counters),
+            }
+            _print_report(report)
+            reports.append(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"version": _version(), "python": sys.version.split()[0], "args": vars(args),
+                       "runs": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Measure the cold start cost of each entry point: every run is done in a fresh interpreter, timing the import of
+the module the functions host loads (function_app) and the first use of what each kind of function needs.
+
+    python -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# each entry point: (name, code timed in a fresh interpreter)
+_ENTRY_POINTS = [
+    ("import function_app (http trigger, orchestrators)", "import function_app"),
+    ("graph activities (credential + graph client)",
+     "import function_app; function_app._get_graph_client()"),
+    ("indexing activities (embedding model + reader)",
+     "import function_app; function_app.azure.get_embed_model(); from llama_index.core import SimpleDirectoryReader"),
+    ("import util.graph", "import util.graph"),
+    ("import util.azure", "import util.azure"),
+]
+
+_TIMER = """
+import json, time
+started = time.perf_counter()
+{code}
+print(json.dumps(time.perf_counter() - started))
+"""
+
+
+def _time(code: str):
+    env = dict(os.environ, EMBEDDING_CACHE="none")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", _TIMER.format(code=code)], cwd=root, env=env, check=True,
+                            capture_output=True, text=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    """Print the median/max time of each entry point over the requested number of runs"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    print(f"{'entry point':<55} {'median s':>9} {'max s':>9}")
+    for name, code in _ENTRY_POINTS:
+        timings = [_time(code) for _ in range(args.runs)]
+        print(f"{name:<55} {statistics.median(timings):>9.3f} {max(timings):>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+In process stand-in for the durable functions runtime, enough to drive the orchestrators of function_app.
+
+Orchestrators are plain generators: each task they yield is run (the tasks of a `task_all`/`task_any` on their own
+threads so it fans out like it would on the function app) and its result (or exception) is sent back in. Inputs and
+outputs go through a json round trip like they do with the real runtime.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from datetime import datetime, timezone
+
+from azure.functions.decorators.function_app import FunctionBuilder
+
+__all__ = ["LocalDurableRuntime"]
+
+
+class _Task:
+    """Runs on its own thread once started, `result` is then its value or exception (like the durable tasks)"""
+    def __init__(self, run):
+        self._run = run
+        self._future = None
+        self.result = None
+
+    def start(self):
+        """Start the task if it isn't yet, returns its future"""
+        if self._future is None:
+            self._future = Future()
+            threading.Thread(target=self._complete, daemon=True).start()
+        return self._future
+
+    def _complete(self):
+        try:
+            self.result = self._run()
+        except Exception as e: # pylint: disable=broad-exception-caught
+            self.result = e
+            self._future.set_exception(e)
+        else:
+            self._future.set_result(self.result)
+
+    def run(self):
+        """Start the task and wait for its value"""
+        return self.start().result()
+
+
+class _Context:
+    """What the orchestrators get as `context`"""
+    def __init__(self, runtime: "LocalDurableRuntime", instance_id: str, input_data):
+        self._runtime = runtime
+        self.instance_id = instance_id
+        self._input = input_data
+        self.continued_as_new = False
+        self.custom_status = None
+
+    def get_input(self):
+        """Orchestration input"""
+        return self._input
+
+    @property
+    def current_utc_datetime(self):
+        """Replay safe 'now'"""
+        return datetime.now(timezone.utc)
+
+    def call_activity(self, name: str, input_=None):
+        """Run an activity"""
+        return _Task(lambda: self._runtime.call_activity(name, input_))
+
+    def call_sub_orchestrator(self, name: str, input_=None, instance_id: str = None):
+        """Run a sub orchestration (synchronously, on the thread it is called from)"""
+        return _Task(lambda: self._runtime.run(name, input_, instance_id))
+
+    def task_all(self, tasks: list):
+        """Run the tasks at once, raises the first exception if any of them failed"""
+        def run_all():
+            futures = [task.start() for task in tasks]
+            return [future.result() for future in futures]
+        return _Task(run_all)
+
+    def task_any(self, tasks: list):
+        """Run the tasks (the ones already running keep going), returns the first one to complete"""
+        def run_any():
+            futures = [task.start() for task in tasks]
+            wait(futures, return_when=FIRST_COMPLETED)
+            return next(task for task, future in zip(tasks, futures) if future.done())
+        return _Task(run_any)
+
+    def set_custom_status(self, status):
+        """Kept on the context (and in the runtime statuses)"""
+        self.custom_status = _roundtrip(status)
+        self._runtime.statuses[self.instance_id] = self.custom_status
+
+    def continue_as_new(self, input_):
+        """Restart the orchestration with a new input once the generator returns"""
+        self._input = _roundtrip(input_)
+        self.continued_as_new = True
+
+
+def _roundtrip(value):
+    return json.loads(json.dumps(value))
+
+
+class LocalDurableRuntime: # pylint: disable=too-many-instance-attributes
+    """
+    Finds the activities and orchestrators of a function app module (DFApp decorated functions) and runs them.
+
+    At most `max_activities` activities run at once (the host default of maxConcurrentActivityFunctions is 10 per
+    core), `timings` holds the duration of every activity call by activity name.
+    """
+    def __init__(self, module, max_activities: int = 10 * (os.cpu_count() or 1)):
+        self.activities = {}
+        self.orchestrators = {}
+        for name, value in vars(module).items():
+            if not isinstance(value, FunctionBuilder):
+                continue
+            function = value.build().get_user_function()
+            if hasattr(function, "orchestrator_function"):
+                self.orchestrators[name] = function.orchestrator_function
+            else:
+                self.activities[name] = function
+        self.timings = defaultdict(list)
+        self.statuses = {}
+        self._lock = threading.Lock()
+        self._instances = 0
+        self._activity_slots = threading.Semaphore(max_activities)
+        # async activities share one event loop, like on the python worker (the sdk clients are bound to it).
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    def call_activity(self, name: str, input_):
+        """Run an activity (coroutines on the event loop) and record how long it took"""
+        with self._activity_slots:
+            started = time.perf_counter()
+            try:
+                result = self.activities[name](_roundtrip(input_))
+                if asyncio.iscoroutine(result):
+                    result = asyncio.run_coroutine_threadsafe(result, self._loop).result()
+                return _roundtrip(result)
+            finally:
+                with self._lock:
+                    self.timings[name].append(time.perf_counter() - started)
+
+    def run(self, name: str, input_, instance_id: str = None):
+        """Run an orchestration to completion (following continue_as_new), returns its output"""
+        with self._lock:
+            self._instances += 1
+            instance_id = instance_id or f"{name}-{self._instances}"
+        input_ = _roundtrip(input_)
+        while True:
+            context = _Context(self, instance_id, input_)
+            output = self._drive(self.orchestrators[name](context))
+            if not context.continued_as_new:
+                return _roundtrip(output)
+            input_ = context.get_input()
+
+    @staticmethod
+    def _drive(generator):
+        if not hasattr(generator, "send"):
+            return generator
+        value, error = None, None
+        while True:
+            try:
+                task = generator.throw(error) if error else generator.send(value)
+            except StopIteration as stop:
+                return stop.value
+            value, error = None, None
+            try:
+                value = task.run()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                error = e
@@ -0,0 +1,267 @@
+"""
+Local stand-in for the few Microsoft Graph drive endpoints used by the indexer.
+
+Serves a synthetic folder tree (site and drive lookups, children listings, delta queries, item lookups and file
+downloads, with byte ranges and expiring download urls) so the crawl can be exercised without a SharePoint tenant.
+Point the function app to it with GRAPH_API_ENDPOINT=http://127.0.0.1:<port>/v1.0
+
+    python -m fakes.graph --folders 50 --files-per-folder 10
+"""
+import argparse
+import base64
+import hashlib
+import re
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlparse
+
+from .server import FakeServer, JsonHandler
+
+__all__ = ["FakeGraph", "FakeGraphServer"]
+
+_DEFAULT_PAGE_SIZE = 200
+_TIMESTAMP = "2024-01-01T00:00:00Z"
+
+class FakeGraph: # pylint: disable=too-many-instance-attributes
+    """
+    In-memory drive: a tree of `folders` folders (each one having up to `fanout` sub folders) with
+    `files_per_folder` files in each of them, plus a change log to answer delta queries.
+
+    With `distinct_files` the files cycle over that many contents (copies of the same file in different folders),
+    the hashes stand in for the quickXorHash of graph (any hash of the content does for the indexer).
+    """
+    def __init__(self, folders: int = 10, files_per_folder: int = 10, fanout: int = 10, drive_id: str = "drive0", # pylint: disable=too-many-arguments,too-many-positional-arguments
+                 file_size: int = 1024, drive_name: str = "Documents", distinct_files: int = 0):
+        self.drive_id = drive_id
+        self.drive_name = drive_name
+        self.site_id = "site0"
+        self.file_size = file_size
+        self.distinct_files = distinct_files
+        self.files = 0
+        self.base_url = ""
+        self.version = 0
+        # delta tokens older than this are answered with a 410 (resync required)
+        self.expired_before = 0
+        # download urls embed it, the ones of a previous epoch are answered with a 401 (see expire_download_urls)
+        self.download_epoch = 0
+        self._lock = threading.Lock()
+        self._items = {"root": {"id": "root", "name": "root", "root": {}, "folder": {"childCount": 0},
+                                "parentReference": {"driveId": drive_id}, "version": 0}}
+        self._children = {"root": []}
+        for i in range(folders):
+            parent = "root" if i < fanout else f"folder{(i - fanout) // fanout}"
+            self._add("folder", f"folder{i}", f"Folder {i}", parent)
+        for folder in ["root"] + [f"folder{i}" for i in range(folders)]:
+            for j in range(files_per_folder):
+                self._add("file", f"{folder}-file{j}", f"{folder}-file{j}.txt", folder)
+
+    def _add(self, kind: str, item_id: str, name: str, parent: str):
+        item = {"id": item_id, "name": name, "webUrl": f"https://fake.sharepoint.com/{item_id}",
+                "lastModifiedDateTime": _TIMESTAMP, "parentReference": {"driveId": self.drive_id, "id": parent},
+                "version": self.version}
+        if kind == "folder":
+            item["folder"] = {"childCount": 0}
+            self._children[item_id] = []
+        else:
+            item["file"] = {"mimeType": "text/plain"}
+            item["size"] = self.file_size
+            item["content"] = f"content {self.files % self.distinct_files}" if self.distinct_files else name
+            self.files += 1
+        self._items[item_id] = item
+        self._children[parent].append(item_id)
+        self._items[parent]["folder"]["childCount"] += 1
+        return item
+
+    def add_file(self, parent: str, name: str):
+        """Create a new file in the parent folder"""
+        with self._lock:
+            self.version += 1
+            return self._add("file", f"{parent}-{name}", name, parent)
+
+    def update_file(self, item_id: str):
+        """Touch a file so it shows up in the next delta"""
+        with self._lock:
+            self.version += 1
+            item = self._items[item_id]
+            item["version"] = self.version
+            item["lastModifiedDateTime"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+
+    def delete_item(self, item_id: str):
+        """Delete a file or a folder (and everything under it)"""
+        with self._lock:
+            self.version += 1
+            stack = [item_id]
+            while stack:
+                current = self._items[stack.pop()]
+                current["deleted"] = {"state": "deleted"}
+                current["version"] = self.version
+                stack.extend(self._children.get(current["id"], []))
+            parent = self._items[item_id]["parentReference"]["id"]
+            self._children[parent].remove(item_id)
+            self._items[parent]["folder"]["childCount"] -= 1
+
+    def move_item(self, item_id: str, parent: str):
+        """Move a file or a folder (and everything under it) to another folder"""
+        with self._lock:
+            self.version += 1
+            item = self._items[item_id]
+            previous = item["parentReference"]["id"]
+            self._children[previous].remove(item_id)
+            self._items[previous]["folder"]["childCount"] -= 1
+            self._children[parent].append(item_id)
+            self._items[parent]["folder"]["childCount"] += 1
+            item["parentReference"] = dict(item["parentReference"], id=parent)
+            item["version"] = self.version
+
+    def subtree(self, folder_id: str = "root"):
+        """Ids of the (not deleted) items under a folder, at any depth"""
+        with self._lock:
+            ids = []
+            stack = list(self._children.get(folder_id, []))
+            while stack:
+                item_id = stack.pop()
+                ids.append(item_id)
+                stack.extend(self._children.get(item_id, []))
+            return ids
+
+    def expire_download_urls(self):
+        """The download urls handed out so far stop working"""
+        with self._lock:
+            self.download_epoch += 1
+
+    def _render(self, item: dict):
+        rendered = {k: v for k, v in item.items() if k not in ("version", "content")}
+        if "file" in item and "deleted" not in item:
+            rendered["@microsoft.graph.downloadUrl"] = \
+                f"{self.base_url}/download/{item['id']}?epoch={self.download_epoch}"
+            digest = base64.b64encode(hashlib.sha1(self.content(item["id"])).digest()).decode()
+            rendered["file"] = item["file"] | {"hashes": {"quickXorHash": digest}}
+        return rendered
+
+    def item(self, item_id: str):
+        """A single (not deleted) item, None if there is no such item"""
+        item = self._items.get(item_id)
+        return self._render(item) if item and "deleted" not in item else None
+
+    def children(self, folder_id: str):
+        """Listing of a folder"""
+        return [self._render(self._items[i]) for i in self._children[folder_id]]
+
+    def delta(self, since: int = None):
+        """Items changed after the `since` version (the whole drive if None), parents before their children"""
+        ordered = []
+        stack = ["root"]
+        while stack:
+            item = self._items[stack.pop()]
+            ordered.append(item)
+            stack.extend(reversed(self._children.get(item["id"], [])))
+        if since is None:
+            return [self._render(i) for i in ordered]
+        ordered.extend(i for i in self._items.values() if "deleted" in i)
+        return [self._render(i) for i in ordered if i["version"] > since]
+
+    def content(self, item_id: str):
+        """Bytes of a file, its version is on the last line so an update only changes the end of the file"""
+        line = f"{self._items[item_id]['content']}\n".encode()
+        last = f"version {self._items[item_id]['version']}\n".encode()
+        size = max(0, self.file_size - len(last))
+        return (line * (size // len(line) + 1))[:size] + last
+
+
+class _Handler(JsonHandler):
+    server: "FakeGraphServer"
+
+    def _page(self, items: list, query: dict, link: str):
+        top = int(query.get("$top", [_DEFAULT_PAGE_SIZE])[0])
+        skip = int(query.get("$skiptoken", [0])[0])
+        body = {"value": items[skip:skip + top]}
+        if skip + top < len(items):
+            body["@odata.nextLink"] = f"{link}{'&' if '?' in link else '?'}$top={top}&$skiptoken={skip + top}"
+        return body
+
+    def _download(self, item_id: str, epoch: int):
+        graph = self.server.graph
+        if epoch != graph.download_epoch:
+            self._json({"error": {"code": "unauthenticated", "message": "Download url expired"}}, status=401)
+            return
+        content = graph.content(item_id)
+        match = re.match(r"^bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if not match:
+            self._send(content)
+            return
+        start = int(match.group(1))
+        end = min(int(match.group(2) or len(content) - 1), len(content) - 1)
+        self._send(content[start:end + 1], status=206,
+                   headers={"Content-Range": f"bytes {start}-{end}/{len(content)}", "Accept-Ranges": "bytes"})
+
+    def route(self, method: str):
+        """Route the few endpoints we support"""
+        graph = self.server.graph
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        parts = parsed.path.strip("/").split("/")
+        base = f"{graph.base_url}/v1.0/drives/{graph.drive_id}"
+        if parts[0] == "download":
+            self._download(parts[1], int(query.get("epoch", [0])[0]))
+        elif parts[1:2] == ["sites"] and len(parts) == 3:
+            # site lookup by path (msgraph sdk), the id is <host>,<site id>,<web id>
+            self._json({"id": f"fake.sharepoint.com,{graph.site_id},{graph.site_id}", "name": unquote(parts[2])})
+        elif parts[1:2] == ["sites"] and parts[-1] == "drives":
+            self._json({"value": [{"@odata.type": "#microsoft.graph.drive", "id": graph.drive_id,
+                                   "name": graph.drive_name}]})
+        elif parts[1:2] == ["drives"] and parts[-2] == "items":
+            item = graph.item(parts[-1])
+            if item is None:
+                self._json({"error": {"code": "itemNotFound"}}, status=404)
+            else:
+                self._json(item)
+        elif parts[-1] == "children":
+            folder = "root" if parts[-2] == "root" else parts[-2]
+            link = f"{base}/root/children" if folder == "root" else f"{base}/items/{folder}/children"
+            self._json(self._page(graph.children(folder), query, link))
+        elif parts[-1] == "delta":
+            since = int(query["token"][0]) if "token" in query else None
+            if since is not None and since < graph.expired_before:
+                self._json({"error": {"code": "resyncRequired"}}, status=410)
+                return
+            link = f"{base}/root/delta" if since is None else f"{base}/root/delta?token={since}"
+            body = self._page(graph.delta(since), query, link)
+            if "@odata.nextLink" not in body:
+                body["@odata.deltaLink"] = f"{base}/root/delta?token={graph.version}"
+            self._json(body)
+        else:
+            self._json({"error": {"code": "itemNotFound"}}, status=404)
+
+
+class FakeGraphServer(FakeServer):
+    """Serves a FakeGraph on a local port from a background thread, use as a context manager"""
+
+    def __init__(self, graph: FakeGraph, port: int = 0, latency: float = 0.0, throttle_every: int = 0,
+                 retry_after: float = 1.0):
+        super().__init__(_Handler, port, latency, throttle_every, retry_after)
+        self.graph = graph
+        graph.base_url = self.base_url
+
+    @property
+    def endpoint(self):
+        """Value to use as GRAPH_API_ENDPOINT"""
+        return f"{self.graph.base_url}/v1.0"
+
+
+def main():
+    """Run the fake graph server until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--folders", type=int, default=50)
+    parser.add_argument("--files-per-folder", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every n-th request with a 429")
+    args = parser.parse_args()
+    with FakeGraphServer(FakeGraph(args.folders, args.files_per_folder), args.port, args.latency,
+                         args.throttle_every) as server:
+        print(f"Serving drive '{server.graph.drive_id}' on {server.endpoint}")
+        server.serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Local stand-in for the Azure OpenAI embeddings endpoint.
+
+Returns a deterministic (seeded by the text) unit vector per input, as floats or base64 as the client asks, along
+with a rough token usage. Point the function app to it with AZURE_OPENAI_ENDPOINT=http://127.0.0.1:<port>
+
+    python -m fakes.openai --port 8083
+"""
+import argparse
+import base64
+import hashlib
+import random
+import re
+import threading
+from array import array
+from urllib.parse import urlparse
+
+from .server import FakeServer, JsonHandler
+
+__all__ = ["FakeOpenAI", "FakeOpenAIServer"]
+
+
+class FakeOpenAI:
+    """Embedding 'model' keeping track of what it was asked for"""
+    def __init__(self, dimensions: int = 1536):
+        self.dimensions = dimensions
+        self.inputs = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def embed(self, text: str):
+        """Unit vector seeded by the text"""
+        generator = random.Random(hashlib.sha256(text.encode()).digest())
+        vector = [generator.gauss(0, 1) for _ in range(self.dimensions)]
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+    def embeddings(self, inputs: list[str], encoding_format: str = "float"):
+        """Body of an embeddings response"""
+        tokens = sum(len(text.split()) for text in inputs)
+        with self._lock:
+            self.inputs += len(inputs)
+            self.tokens += tokens
+        data = []
+        for i, text in enumerate(inputs):
+            embedding = self.embed(text)
+            if encoding_format == "base64":
+                embedding = base64.b64encode(array("f", embedding).tobytes()).decode()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        return {"object": "list", "data": data, "model": "fake-embedding",
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+
+class _Handler(JsonHandler):
+    server: "FakeOpenAIServer"
+
+    def route(self, method: str):
+        """Only embeddings are supported"""
+        path = urlparse(self.path).path
+        if method != "POST" or not re.search(r"/openai/deployments/[^/]+/embeddings$", path):
+            self._json({"error": {"code": "404", "message": "Resource not found"}}, status=404)
+            return
+        body = self._body()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self._json(self.server.openai.embeddings(inputs, body.get("encoding_format", "float")))
+
+
+class FakeOpenAIServer(FakeServer):
+    """Serves a FakeOpenAI on a local port from a background thread, use as a context manager"""
+
+    def __init__(self, openai: FakeOpenAI, port: int = 0, latency: float = 0.0, throttle_every: int = 0,
+                 retry_after: float = 1.0):
+        super().__init__(_Handler, port, latency, throttle_every, retry_after)
+        self.openai = openai
+
+    @property
+    def endpoint(self):
+        """Value to use as AZURE_OPENAI_ENDPOINT"""
+        return self.base_url
+
+
+def main():
+    """Run the fake openai server until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8083)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every n-th request with a 429")
+    args = parser.parse_args()
+    with FakeOpenAIServer(FakeOpenAI(), args.port, args.latency, args.throttle_every) as server:
+        print(f"Serving embeddings on {server.endpoint}")
+        server.serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Local stand-in for the Azure AI Search endpoints used by the indexer.
+
+Keeps the indexes in memory: index listing/creation, document batches (upload, merge, mergeOrUpload and delete) and
+searches with the filters the indexer sends (`search.in`, `not search.in`, comparisons, combined with `and`), paged
+like the service does (1000 results per response at most, no `skip` over 100000).
+The sdk refuses plain http, it is served over https with a self-signed certificate: point the function app to it
+with AZURE_SEARCH_SERVICE_ENDPOINT=https://127.0.0.1:<port> and REQUESTS_CA_BUNDLE=<certificate printed on start>
+
+    python -m fakes.search --port 8082
+"""
+import argparse
+import re
+import threading
+from urllib.parse import unquote, urlparse
+
+from .server import FakeServer, JsonHandler
+
+__all__ = ["FakeSearch", "FakeSearchServer"]
+
+# page size of a search without `top`, a continuation is returned when there are more results
+_DEFAULT_PAGE_SIZE = 50
+# most results of a response (a continuation is returned for the rest of `top`) and highest `skip`
+_MAX_PAGE_SIZE = 1000
+_MAX_SKIP = 100000
+_SEARCH_IN = re.compile(r"^(not\s+)?search\.in\((\w+),\s*'((?:[^']|'')*)'(?:,\s*'([^']*)')?\)$")
+_COMPARISON = re.compile(r"^(\w+)\s+(eq|ne|gt|ge|lt|le)\s+'((?:[^']|'')*)'$")
+_OPERATORS = {"eq": lambda a, b: a == b, "ne": lambda a, b: a != b, "gt": lambda a, b: a > b,
+              "ge": lambda a, b: a >= b, "lt": lambda a, b: a < b, "le": lambda a, b: a <= b}
+
+class FakeSearch:
+    """In-memory search service: {index name: {'definition': dict, 'documents': {key: document}}}"""
+    def __init__(self):
+        self.indexes = {}
+        self._lock = threading.Lock()
+
+    def create_index(self, definition: dict):
+        """Create (or replace) an index"""
+        with self._lock:
+            self.indexes[definition["name"]] = {"definition": definition, "documents": {}}
+        return definition
+
+    def _key(self, index_name: str):
+        fields = self.indexes[index_name]["definition"].get("fields", [])
+        return next((field["name"] for field in fields if field.get("key")), "id")
+
+    def index(self, index_name: str, actions: list[dict]):
+        """Apply a batch of document actions, returns the per document results"""
+        with self._lock:
+            documents = self.indexes[index_name]["documents"]
+            key = self._key(index_name)
+            results = []
+            for action in actions:
+                kind = action.pop("@search.action", "upload")
+                document_key = action[key]
+                if kind == "delete":
+                    documents.pop(document_key, None)
+                elif kind in ("merge", "mergeOrUpload") and document_key in documents:
+                    documents[document_key].update(action)
+                else:
+                    documents[document_key] = action
+                results.append({"key": document_key, "status": True, "errorMessage": None,
+                                "statusCode": 200 if kind == "delete" else 201})
+            return results
+
+    def search(self, index_name: str, query: dict):
+        """Returns (matching documents of the page, total count, parameters of the next page or None)"""
+        skip = query.get("skip", 0)
+        if skip > _MAX_SKIP:
+            raise ValueError(f"skip can't be over {_MAX_SKIP}")
+        predicate = _parse_filter(query.get("filter"))
+        with self._lock:
+            matches = [document for document in self.indexes[index_name]["documents"].values()
+                       if predicate(document)]
+        top = query.get("top")
+        page = matches[skip:skip + min(top or _DEFAULT_PAGE_SIZE, _MAX_PAGE_SIZE)]
+        if query.get("select"):
+            fields = [field.strip() for field in query["select"].split(",")]
+            page = [{field: document.get(field) for field in fields} for document in page]
+        next_page = None
+        if skip + len(page) < len(matches) and (top is None or len(page) < top):
+            next_page = dict(query, skip=skip + len(page))
+            if top is not None:
+                next_page["top"] = top - len(page)
+        return page, len(matches), next_page
+
+
+def _parse_filter(odata_filter: str):
+    """Turns the (small) subset of OData filters we use into a predicate on a document"""
+    if not odata_filter:
+        return lambda document: True
+    clauses = []
+    for clause in re.split(r"\s+and\s+(?=(?:[^']*'[^']*')*[^']*$)", odata_filter.strip()):
+        match = _SEARCH_IN.match(clause.strip())
+        if match:
+            negate, field, values, separator = match.groups()
+            values = set(values.replace("''", "'").split(separator or ","))
+            clauses.append(lambda document, f=field, v=values, n=bool(negate): (document.get(f) in v) != n)
+            continue
+        match = _COMPARISON.match(clause.strip())
+        if match:
+            field, operator, value = match.group(1), _OPERATORS[match.group(2)], match.group(3).replace("''", "'")
+            clauses.append(lambda document, f=field, o=operator, v=value:
+                           document.get(f) is not None and o(document.get(f), v))
+            continue
+        raise ValueError(f"Unsupported filter: {clause}")
+    return lambda document: all(clause(document) for clause in clauses)
+
+
+class _Handler(JsonHandler):
+    server: "FakeSearchServer"
+
+    def route(self, method: str):
+        """Route the few endpoints we support"""
+        search = self.server.search
+        path = unquote(urlparse(self.path).path).strip("/")
+        body = self._body() if method == "POST" else {}
+        match = re.match(r"^indexes(?:\('([^']+)'\)|/([^/]+))?(?:/docs/(search\.index|search\.post\.search))?$", path)
+        if not match:
+            self._json({"error": {"code": "NotFound", "message": path}}, status=404)
+            return
+        index_name = match.group(1) or match.group(2)
+        operation = match.group(3)
+        if index_name is None:
+            if method == "POST":
+                self._json(search.create_index(body), status=201)
+            else:
+                self._json({"value": [{"name": name} for name in search.indexes]})
+        elif index_name not in search.indexes:
+            self._json({"error": {"code": "ResourceNotFound", "message": f"Index {index_name} not found"}},
+                       status=404)
+        elif operation == "search.index":
+            self._json({"value": search.index(index_name, body["value"])})
+        elif operation == "search.post.search":
+            try:
+                page, count, next_page = search.search(index_name, body)
+            except ValueError as e:
+                self._json({"error": {"code": "InvalidRequestParameter", "message": str(e)}}, status=400)
+                return
+            result = {"value": [dict(document, **{"@search.score": 1.0}) for document in page]}
+            if body.get("count"):
+                result["@odata.count"] = count
+            if next_page is not None:
+                result["@search.nextPageParameters"] = next_page
+            self._json(result)
+        else:
+            self._json(search.indexes[index_name]["definition"])
+
+
+class FakeSearchServer(FakeServer):
+    """Serves a FakeSearch on a local port from a background thread, use as a context manager"""
+
+    def __init__(self, search: FakeSearch, port: int = 0, latency: float = 0.0, throttle_every: int = 0,
+                 retry_after: float = 1.0):
+        super().__init__(_Handler, port, latency, throttle_every, retry_after, tls=True)
+        self.search = search
+
+    @property
+    def endpoint(self):
+        """Value to use as AZURE_SEARCH_SERVICE_ENDPOINT"""
+        return self.base_url
+
+
+def main():
+    """Run the fake search server until interrupted"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every n-th request with a 429")
+    args = parser.parse_args()
+    with FakeSearchServer(FakeSearch(), args.port, args.latency, args.throttle_every) as server:
+        print(f"Serving search on {server.endpoint} (certificate: {server.certificate})")
+        server.serve()
+
+
+if __name__ == "__main__":
+    main()
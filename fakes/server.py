@@ -0,0 +1,148 @@
+"""
+Plumbing shared by the local stand-ins: a threaded http(s) server adding latency and throttling to every request.
+"""
+import datetime
+import ipaddress
+import json
+import os
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+__all__ = ["FakeServer", "JsonHandler"]
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    """Base request handler, subclasses implement `route(method)`"""
+    server: "FakeServer"
+    protocol_version = "HTTP/1.1"
+    # headers and body are separate writes, don't wait on the client delayed ack between them.
+    disable_nagle_algorithm = True
+
+    def log_message(self, *_): # pylint: disable=arguments-differ
+        pass
+
+    def _json(self, body: dict, status: int = 200, headers: dict = None):
+        self._send(json.dumps(body).encode(), status, dict({"Content-Type": "application/json"}, **(headers or {})))
+
+    def _send(self, payload: bytes, status: int = 200, headers: dict = None):
+        self.send_response(status)
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def _handle(self, method: str):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.should_throttle():
+            self._json({"error": {"code": "TooManyRequests", "message": "Throttled by the fake server"}}, status=429,
+                       headers={"Retry-After": str(self.server.retry_after)})
+            return
+        self.route(method)
+
+    def route(self, method: str):
+        """Answer the request"""
+        raise NotImplementedError
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """Dispatch to route"""
+        self._handle("GET")
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """Dispatch to route"""
+        self._handle("POST")
+
+
+def _self_signed_certificate():
+    """Writes a certificate (and its key) for 127.0.0.1 in a temporary directory, returns their paths"""
+    # pylint: disable=import-outside-toplevel
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name)
+                   .issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(minutes=5))
+                   .not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]),
+                                  critical=False)
+                   .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                   .sign(key, hashes.SHA256()))
+    directory = tempfile.mkdtemp(prefix="fake-server-")
+    certificate_path = os.path.join(directory, "certificate.pem")
+    key_path = os.path.join(directory, "key.pem")
+    with open(certificate_path, "wb") as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return certificate_path, key_path
+
+
+class FakeServer(ThreadingHTTPServer): # pylint: disable=too-many-instance-attributes
+    """
+    Serves a handler on a local port from a background thread, use as a context manager.
+
+    `latency` seconds are added to every request and, when `throttle_every` is set, every n-th request is answered
+    with a 429 and a `retry_after` Retry-After header. With `tls` it is served over https with a self-signed
+    certificate (see `certificate`, i.e. to use as REQUESTS_CA_BUNDLE) for the sdks refusing plain http.
+    """
+    daemon_threads = True
+
+    def __init__(self, handler: type, port: int = 0, latency: float = 0.0, throttle_every: int = 0, # pylint: disable=too-many-arguments
+                 retry_after: float = 1.0, *, tls: bool = False):
+        super().__init__(("127.0.0.1", port), handler)
+        self.certificate = None
+        if tls:
+            self.certificate, key = _self_signed_certificate()
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certificate, key)
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.requests = 0
+        self.throttled = 0
+        self._counter_lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        """http(s)://127.0.0.1:<port>"""
+        return f"{'https' if self.certificate else 'http'}://127.0.0.1:{self.server_address[1]}"
+
+    def should_throttle(self):
+        """Count the request, True if it has to be throttled"""
+        with self._counter_lock:
+            self.requests += 1
+            if self.throttle_every and self.requests % self.throttle_every == 0:
+                self.throttled += 1
+                return True
+            return False
+
+    def serve(self):
+        """Block until interrupted"""
+        self._thread.join()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,70 @@
+"""
+In process stand-in for the blob container client used by util/storage.py (delta states and run manifests).
+
+Only the container client methods the indexer calls are implemented, patch `util.storage._get_container_client` to
+return one (see benchmarks/bench_pipeline.py). Use Azurite to exercise the actual storage sdk.
+"""
+import threading
+
+from azure.core.exceptions import ResourceNotFoundError
+
+__all__ = ["FakeContainerClient"]
+
+
+class _Downloader: # pylint: disable=too-few-public-methods
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def readall(self):
+        """Content of the blob"""
+        return self._data
+
+
+class _BlobClient:
+    def __init__(self, container: "FakeContainerClient", name: str):
+        self._container = container
+        self._name = name
+
+    def download_blob(self):
+        """See FakeContainerClient.download_blob"""
+        return self._container.download_blob(self._name)
+
+    def delete_blob(self):
+        """See FakeContainerClient.delete_blobs"""
+        self._container.delete_blobs(self._name)
+
+
+class FakeContainerClient:
+    """In-memory container: {blob name: bytes}, thread safe"""
+    def __init__(self):
+        self.blobs = {}
+        self._lock = threading.Lock()
+
+    def upload_blob(self, name: str, data, overwrite: bool = False):
+        """Store a blob (str or bytes)"""
+        with self._lock:
+            if name in self.blobs and not overwrite:
+                raise ValueError(f"Blob {name} already exists")
+            self.blobs[name] = data.encode() if isinstance(data, str) else bytes(data)
+
+    def download_blob(self, name: str):
+        """Returns a downloader (readall) of the blob, ResourceNotFoundError if there is no such blob"""
+        with self._lock:
+            if name not in self.blobs:
+                raise ResourceNotFoundError(f"Blob {name} not found")
+            return _Downloader(self.blobs[name])
+
+    def get_blob_client(self, name: str):
+        """Client of a single blob"""
+        return _BlobClient(self, name)
+
+    def list_blob_names(self, name_starts_with: str = ""):
+        """Names of the blobs starting with the prefix"""
+        with self._lock:
+            return sorted(name for name in self.blobs if name.startswith(name_starts_with))
+
+    def delete_blobs(self, *names: str):
+        """Delete the blobs (the missing ones are ignored)"""
+        with self._lock:
+            for name in names:
+                self.blobs.pop(name, None)
@@ -1,42 +1,83 @@
+import asyncio
 import logging
 import os
-import tempfile
 import uuid
-from http.client import HTTPException
+from contextlib import ExitStack
+from datetime import datetime
+from functools import cache, partial
 
 import azure.durable_functions as df
 import azure.functions as func
-import requests
 from azure.durable_functions import (DurableOrchestrationClient,
                                      DurableOrchestrationContext)
-from azure.identity import (DefaultAzureCredential, ManagedIdentityCredential,
-                            get_bearer_token_provider)
-from llama_index.core import SimpleDirectoryReader
-from msgraph import GraphServiceClient
 
-from util import graph, azure
+from util import graph, azure, storage, download, parsing, throttle, metrics, dedupe
 
 app = df.DFApp(http_auth_level=func.AuthLevel.FUNCTION)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-_DL_DIRECTORY = "sharepoint_indexer"
-_FILE_UNDERSCORE = "___"
+# how many groups of files are processed at once by the orchestrator, can be overridden per request via
+# `max_concurrency`
+_MAX_CONCURRENT_FILES = int(os.getenv("MAX_CONCURRENT_FILES", "10"))
+# how many files are downloaded then indexed together, can be overridden per request via `batch_size`
+_INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "20"))
+# how many sites/drives a batch (see start_batch) indexes at once, can be overridden per request via `max_sites`
+_MAX_CONCURRENT_SITES = int(os.getenv("MAX_CONCURRENT_SITES", "4"))
+# failed files listed in the orchestration output, they are all in the results saved with the manifest
+_MAX_REPORTED_FAILURES = int(os.getenv("MAX_REPORTED_FAILURES", "100"))
 
 _scopes = ["https://graph.microsoft.com/.default"]
-# Determine the appropriate credential to use
 azure_client_id: str    = os.getenv("AZURE_CLIENT_ID")
 
-if azure_client_id:
-    _credential = ManagedIdentityCredential(client_id=azure_client_id)
-    logger.info("Loading up ManagedIdentityCredential")
-else:
-    _credential = DefaultAzureCredential()
+# NOTE: the credential, graph client and heavy libraries (msgraph, llama_index) are only loaded by the activities
+# that need them, so the http trigger and the orchestrators don't pay for it on a cold start.
+@cache
+def _get_credential():
+    """Determine the appropriate credential to use"""
+    # pylint: disable=import-outside-toplevel
+    from azure.identity import DefaultAzureCredential, ManagedIdentityCredential
+    if azure_client_id:
+        logger.info("Loading up ManagedIdentityCredential")
+        return ManagedIdentityCredential(client_id=azure_client_id)
     logger.info("Loading up DefaultAzureCredential")
-_bearer_token_provider = get_bearer_token_provider(_credential,
-                                                   "https://graph.microsoft.com/.default")
-_graph_client = GraphServiceClient(_credential, _scopes)
+    return DefaultAzureCredential()
+
+@cache
+def _get_bearer_token_provider():
+    """Token provider for the graph API scope"""
+    from azure.identity import get_bearer_token_provider # pylint: disable=import-outside-toplevel
+    return get_bearer_token_provider(_get_credential(), "https://graph.microsoft.com/.default")
+
+def _get_graph_token():
+    """Returns a (cached until it expires) bearer token for the graph API"""
+    return _get_bearer_token_provider()()
+
+def _is_true(value):
+    """Flag of a query string or a json body, "false"/"0" being false like false"""
+    return str(value).strip().lower() in ("true", "1")
+
+def _to_int(value, default: int):
+    """Positive int of a query string or a json body, `default` if it isn't set. Raises ValueError if it isn't one"""
+    if value is None or value == "":
+        return default
+    try:
+        number = int(value) if not isinstance(value, (bool, float)) else None
+    except (TypeError, ValueError):
+        number = None
+    if number is None or number < 1:
+        raise ValueError(f"{value!r} is not a positive integer")
+    return number
+
+@cache
+def _get_graph_client():
+    """Graph SDK client, pointed to GRAPH_API_ENDPOINT"""
+    from msgraph import GraphServiceClient # pylint: disable=import-outside-toplevel
+    graph_client = GraphServiceClient(_get_credential(), _scopes)
+    graph_client.request_adapter.base_url = graph.GRAPH_API_ENDPOINT
+    return graph_client
+
 _domain = os.getenv("SHAREPOINT_DOMAIN", "163gc.sharepoint.com")
 
 @app.route(route="index_sharepoint_site_files", auth_level=func.AuthLevel.FUNCTION)
@@ -52,75 +93,413 @@ async def index_sharepoint_site_files(req: func.HttpRequest, client: DurableOrch
 
     site_name = req.params.get( 'site_name')
     drive_name = req.params.get('drive_name')
+    max_concurrency = req.params.get('max_concurrency')
+    batch_size = req.params.get('batch_size')
+    delta = _is_true(req.params.get('delta', ''))
     if not site_name or not drive_name:
         try:
             req_body = req.get_json()
         except ValueError:
             pass
         else:
+            req_body = req_body if isinstance(req_body, dict) else {}
             site_name = req_body.get('site_name')
             drive_name = req_body.get('drive_name')
+            max_concurrency = req_body.get('max_concurrency', max_concurrency)
+            batch_size = req_body.get('batch_size', batch_size)
+            delta = _is_true(req_body.get('delta', delta))
 
     if site_name and drive_name:
-        input_data = {
-            "site_name": site_name,
-            "drive_name": drive_name,
-            "run_id": str(uuid.uuid4())
-        }
+        try:
+            input_data = {
+                "site_name": site_name,
+                "drive_name": drive_name,
+                "run_id": str(uuid.uuid4()),
+                "max_concurrency": _to_int(max_concurrency, _MAX_CONCURRENT_FILES),
+                "batch_size": _to_int(batch_size, _INDEX_BATCH_SIZE),
+                "delta": delta
+            }
+        except ValueError as e:
+            return func.HttpResponse(body=f"Unable to start durable function, `max_concurrency` and `batch_size` "
+                                     f"must be positive integers: {e}", status_code=400)
         instance_id = await client.start_new("start", None, client_input=input_data)
         logger.info("Started orchestration with ID = %s", instance_id)
         return client.create_check_status_response(req, instance_id)
     return func.HttpResponse(body="Unable to start durable function due to missing parameters", status_code=400)
 
+@app.route(route="index_sharepoint_sites", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
+@app.durable_client_input(client_name="client")
+async def index_sharepoint_sites(req: func.HttpRequest, client: DurableOrchestrationClient) -> func.HttpResponse:
+    """
+    Index a batch of sites/drives with a single orchestration (see start_batch), the body being
+    {"targets": [{"site_name": .., "drive_name": ..[, "delta": ..]}], "max_sites", "max_concurrency", "batch_size",
+    "delta"}. `max_concurrency` is the number of groups of files indexed at once for the whole batch.
+    """
+    try:
+        req_body = req.get_json()
+    except ValueError:
+        req_body = {}
+    targets = req_body.get('targets') if isinstance(req_body, dict) else None
+    if not targets or not isinstance(targets, list) or any(
+            not isinstance(target, dict) or not all(isinstance(target.get(key), str) and target[key]
+                                                    for key in ('site_name', 'drive_name'))
+            for target in targets):
+        return func.HttpResponse(body="Unable to start durable function, `targets` needs a site_name and a "
+                                 "drive_name for each target", status_code=400)
+    delta = _is_true(req_body.get('delta', False))
+    # the same drive twice would run twice at once (sharing its delta state), only keep the first one.
+    unique = {}
+    for target in targets:
+        unique.setdefault((target['site_name'], target['drive_name']), target)
+    targets = list(unique.values())
+    try:
+        input_data = {
+            "targets": [{"site_name": target['site_name'],
+                         "drive_name": target['drive_name'],
+                         "delta": _is_true(target.get('delta', delta))} for target in targets],
+            "run_id": str(uuid.uuid4()),
+            "max_sites": _to_int(req_body.get('max_sites'), _MAX_CONCURRENT_SITES),
+            "max_concurrency": _to_int(req_body.get('max_concurrency'), _MAX_CONCURRENT_FILES),
+            "batch_size": _to_int(req_body.get('batch_size'), _INDEX_BATCH_SIZE)
+        }
+    except ValueError as e:
+        return func.HttpResponse(body=f"Unable to start durable function, `max_sites`, `max_concurrency` and "
+                                 f"`batch_size` must be positive integers: {e}", status_code=400)
+    instance_id = await client.start_new("start_batch", None, client_input=input_data)
+    logger.info("Started batch orchestration of %s target(s) with ID = %s", len(targets), instance_id)
+    return client.create_check_status_response(req, instance_id)
+
+@app.orchestration_trigger(context_name="context")
+def start_batch(context: DurableOrchestrationContext): # pylint: disable=too-many-locals
+    """
+    Index a batch of sites/drives: each target is indexed by a `start` sub-orchestration, up to `max_sites` at once.
+
+    The site ids and drive urls are looked up once for the whole batch (and each site index created once), a free
+    slot goes to the pending target of the site having the fewest runs going on so that a site with many drives
+    doesn't hold up the others. The groups of files indexed at once (`max_concurrency`) are shared between the runs,
+    no more than `max_concurrency` runs go on at once so that each of them gets at least one.
+
+    The custom status holds the progress of the batch (targets pending/running/succeeded/failed, the runs going on)
+    and the combined summary of the finished runs, the output the result of every target and the combined summary.
+    """
+    input_data = context.get_input()
+    max_concurrency = max(1, input_data.get("max_concurrency", _MAX_CONCURRENT_FILES))
+    max_sites = min(max(1, input_data.get("max_sites", _MAX_CONCURRENT_SITES)), max_concurrency)
+    started = context.current_utc_datetime
+    targets = [target | {'instance_id': f"{context.instance_id}:{i}", 'status': 'pending'}
+               for i, target in enumerate(input_data["targets"])]
+    status = {'progress': {'total': len(targets), 'pending': len(targets), 'running': 0, 'succeeded': 0, 'failed': 0},
+              'summary': metrics.new_summary()}
+    progress = status['progress']
+    context.set_custom_status(status | {'stage': 'lookup'})
+
+    stage_started = context.current_utc_datetime
+    site_names = list(dict.fromkeys(target['site_name'] for target in targets))
+    site_ids = dict(zip(site_names, (yield from _call_each(context, "get_sharepoint_site_info", site_names))))
+    drives = list(dict.fromkeys((target['site_name'], target['drive_name']) for target in targets
+                                if not isinstance(site_ids[target['site_name']], Exception)))
+    urls = dict(zip(drives, (yield from _call_each(context, "get_site_drive_url",
+                                                   [{"site_id": site_ids[site_name], "drive_name": drive_name}
+                                                    for site_name, drive_name in drives]))))
+    indexes = list(dict.fromkeys(site_name for site_name, drive_name in drives
+                                 if urls[site_name, drive_name] and not isinstance(urls[site_name, drive_name],
+                                                                                   Exception)))
+    created = dict(zip(indexes, (yield from _call_each(context, "create_index", indexes))))
+    metrics.add_stage(status['summary'], "site_lookup", _elapsed(context, stage_started))
+
+    pending = []
+    for target in targets:
+        key = (target['site_name'], target['drive_name'])
+        error = next((value for value in (site_ids[key[0]], urls.get(key), created.get(key[0]))
+                      if isinstance(value, Exception)), None)
+        if error is None and not urls.get(key):
+            error = f"Drive {key[1]} not found"
+        if error is None:
+            target['url'] = urls[key]
+            pending.append(target)
+        else:
+            target |= {'status': 'failed', 'error': str(error)}
+            progress['failed'] += 1
+    progress['pending'] = len(pending)
+
+    yield from _run_targets(context, _round_robin(pending), {'run_id': input_data["run_id"],
+                                                             'max_concurrency': max_concurrency // max_sites,
+                                                             'batch_size': input_data.get("batch_size",
+                                                                                          _INDEX_BATCH_SIZE)},
+                            max_sites, status)
+    status['summary']['seconds'] = _elapsed(context, started)
+    context.set_custom_status(status | {'stage': 'done'})
+    return {'targets': [{k: v for k, v in target.items() if k != 'url'} for target in targets],
+            'summary': status['summary']}
+
+def _run_targets(context: DurableOrchestrationContext, pending: list[dict], run_input: dict, max_sites: int,
+                 status: dict):
+    """
+    Run a `start` sub-orchestration (with the `run_input` settings) per pending target, up to `max_sites` at once,
+    and record the outcome of each on the target along with the `progress` and `summary` of the `status`.
+    """
+    progress = status['progress']
+    running = {}
+    while pending or running:
+        while pending and len(running) < max_sites:
+            target = pending.pop(_next_target(pending, running.values()))
+            target['status'] = 'running'
+            task = context.call_sub_orchestrator("start", run_input | {
+                "site_name": target['site_name'],
+                "drive_name": target['drive_name'],
+                "url": target['url'],
+                "run_id": f"{run_input['run_id']}-{target['instance_id'].rsplit(':', 1)[1]}",
+                "delta": target['delta']
+            }, target['instance_id'])
+            running[task] = target
+        progress |= {'pending': len(pending), 'running': len(running)}
+        context.set_custom_status(status | {'stage': 'indexing',
+                                            'running': [{'site_name': target['site_name'],
+                                                         'drive_name': target['drive_name'],
+                                                         'instance_id': target['instance_id']}
+                                                        for target in running.values()]})
+        finished = yield context.task_any(list(running))
+        target = running.pop(finished)
+        if isinstance(finished.result, Exception):
+            logger.error("Unable to index site %s, drive %s -> %s", target['site_name'], target['drive_name'],
+                         finished.result)
+            target |= {'status': 'failed', 'error': str(finished.result)}
+            progress['failed'] += 1
+        else:
+            output = finished.result
+            metrics.add_run_summary(status['summary'], output['summary'])
+            target |= {'status': 'succeeded', 'indexed': output['indexed'], 'failed': len(output['failed']),
+                       'deleted': output['deleted'], 'results': output.get('results')}
+            progress['succeeded'] += 1
+    progress['running'] = 0
+
+def _call_each(context: DurableOrchestrationContext, activity: str, inputs: list):
+    """
+    Call an activity for each input at once, returns the results in order, the failing ones get their exception
+    as result.
+    """
+    tasks = {context.call_activity(activity, value): i for i, value in enumerate(inputs)}
+    results = [None] * len(inputs)
+    while tasks:
+        finished = yield context.task_any(list(tasks))
+        i = tasks.pop(finished)
+        results[i] = finished.result
+        if isinstance(finished.result, Exception):
+            logger.warning("Unable to call %s for %s -> %s", activity, inputs[i], finished.result)
+    return results
+
+def _round_robin(targets: list[dict]):
+    """Order the targets by taking one of each site in turn"""
+    by_site = {}
+    for target in targets:
+        by_site.setdefault(target['site_name'], []).append(target)
+    ordered = []
+    while by_site:
+        for site_name in list(by_site):
+            ordered.append(by_site[site_name].pop(0))
+            if not by_site[site_name]:
+                del by_site[site_name]
+    return ordered
+
+def _next_target(pending: list[dict], running):
+    """Index of the first pending target among the ones of the sites having the fewest runs going on"""
+    counts = {}
+    for target in running:
+        counts[target['site_name']] = counts.get(target['site_name'], 0) + 1
+    return min(range(len(pending)), key=lambda i: (counts.get(pending[i]['site_name'], 0), i))
+
 @app.orchestration_trigger(context_name="context")
 def start(context: DurableOrchestrationContext):
     """
     Initiate the whole process of loading up a site, fetching site items id and then indexing each one of them.
+
+    A batch (see start_batch) passes the drive `url`, the lookups and the index creation are then skipped.
+
+    The crawled files are saved as a manifest in blob storage (pages of MANIFEST_PAGE_SIZE files), the orchestration
+    then handles a page per execution and continues as new with the next page cursor, so that its history stays the
+    same size whatever the size of the drive.
+
+    Files are processed in groups of `batch_size` by up to `max_concurrency` sub-orchestrations at once, a file that
+    fails is reported back in the `failed` list instead of aborting the whole run.
+
+    In `delta` mode only the files that changed since the last delta run are processed (and the deleted ones
+    removed from the index), the whole drive is enumerated when there is no previous run or its token expired.
+
+    The output (and the custom status while running) holds a `summary` of the run: time spent per stage, volumes
+    (bytes, chunks, tokens...) and throttling, see util/metrics.py. The result of every file is saved in the
+    `results` pages of the manifest.
     """
-    files = []
     input_data = context.get_input()
-    drive_name = input_data["drive_name"]
+    run_id = input_data["run_id"]
+    cursor = input_data.get("cursor")
+    summary = input_data.get("summary") or metrics.new_summary()
+    if cursor is None:
+        logger.info('Inside Start function of durable method for site -> %s and drive name -> %s (runId: %s)',
+                    input_data["site_name"],
+                    input_data["drive_name"],
+                    run_id)
+        started = context.current_utc_datetime
+        cursor = yield from _list_files(context, input_data, summary, started)
+        if cursor is None:
+            summary['seconds'] = _elapsed(context, started)
+            _set_status(context, "done", summary)
+            return {'indexed': 0, 'failed': [], 'deleted': 0, 'summary': summary}
+
+    if cursor['page'] < cursor['pages']:
+        yield from _index_page(context, input_data, cursor, summary)
+        cursor['page'] += 1
+        if cursor['page'] < cursor['pages']:
+            context.continue_as_new(input_data | {'cursor': cursor, 'summary': summary})
+            return None
+
+    if input_data.get("delta"):
+        # failed files are reported but not retried by the next delta run, unless they change again.
+        yield context.call_activity("commit_delta_state", {'site_name': input_data["site_name"],
+                                                           'url': cursor['url'],
+                                                           'run_id': run_id})
+    yield context.call_activity("cleanup_run", run_id)
+    summary['seconds'] = _elapsed(context, datetime.fromisoformat(cursor['started']))
+    _set_status(context, "done", summary)
+    return {'indexed': summary['files']['indexed'],
+            'failed': cursor['failed'],
+            'deleted': summary['files']['deleted'],
+            'results': cursor['results'],
+            'summary': summary}
+
+def _list_files(context: DurableOrchestrationContext, input_data: dict, summary: dict, started: datetime):
+    """
+    First execution of `start`: find the drive and create the index (unless the url was passed), crawl the files
+    into the manifest and remove the deleted ones (the orphans after a full crawl, see sync_index) from the index.
+    Returns the page cursor, None if the drive wasn't found.
+    """
+    site_name = input_data["site_name"]
+    run_id = input_data["run_id"]
+    url = input_data.get("url")
+    if not url:
+        stage_started = context.current_utc_datetime
+        site_id = yield context.call_activity("get_sharepoint_site_info", site_name)
+        logger.info("Got the site id -> %s", site_id)
+
+        url = yield context.call_activity("get_site_drive_url", {
+            "site_id": site_id,
+            "drive_name": input_data["drive_name"]
+        })
+        metrics.add_stage(summary, "site_lookup", _elapsed(context, stage_started))
+        if not url:
+            return None
+        # create the index once for the run, the activities then skip the existence checks.
+        yield context.call_activity("create_index", site_name)
+
+    _set_status(context, "listing", summary)
+    stage_started = context.current_utc_datetime
+    if input_data.get("delta"):
+        manifest = yield context.call_activity("get_changed_files", {'site_name': site_name,
+                                                                     'url': url,
+                                                                     'run_id': run_id})
+        for page in range(manifest['deleted_pages']):
+            summary['totals']['removed'] += yield context.call_activity("delete_documents", {'site_name': site_name,
+                                                                                             'run_id': run_id,
+                                                                                             'page': page})
+    else:
+        manifest = yield context.call_activity("get_files", {'url': url, 'run_id': run_id})
+    metrics.add_stage(summary, "listing", _elapsed(context, stage_started))
+    summary['files'] = {'crawled': manifest['files'], 'deleted': manifest.get('deleted', 0), 'to_index': 0,
+                        'indexed': 0, 'failed': 0}
+    logger.info("Got the files from the requested drive, files contained --> %s", manifest['files'])
+
+    if manifest.get('full', True):
+        # the whole drive was crawled, remove what the index holds that isn't in it anymore.
+        _set_status(context, "sync", summary)
+        stage_started = context.current_utc_datetime
+        summary['totals']['removed'] += yield context.call_activity("sync_index", {'site_name': site_name,
+                                                                                  'url': url,
+                                                                                  'run_id': run_id,
+                                                                                  'pages': manifest['pages']})
+        metrics.add_stage(summary, "sync", _elapsed(context, stage_started))
+    return {'url': url, 'page': 0, 'pages': manifest['pages'], 'started': started.isoformat(), 'failed': [],
+            'results': manifest['results']}
+
+def _index_page(context: DurableOrchestrationContext, input_data: dict, cursor: dict, summary: dict): # pylint: disable=too-many-locals
+    """Index the files of a page of the manifest that are new or updated, and save their results"""
     site_name = input_data["site_name"]
     run_id = input_data["run_id"]
-    logger.info('Inside Start function of durable method for site -> %s and drive name -> %s (runId: %s)',
-                site_name,
-                drive_name,
-                run_id)
-    site_id = yield context.call_activity("get_sharepoint_site_info", site_name)
-    logger.info("Got the site id -> %s", site_id)
-
-    url = yield context.call_activity("get_site_drive_url", {
-        "site_id": site_id,
-        "drive_name": drive_name
-    })
-    if url:
-        # initialize the vector store.
-        azure.get_vector_store(site_name)
-
-        files = yield context.call_activity("get_files", url)
-        logger.info("Got the files from the requested drive, files contained --> %s", len(files))
-        for file in files:
-            file['indexed'] = False
-            # check first if it's newer than one existing file in the index
-            is_updated = yield context.call_activity("is_document_updated",
-                                                    {
-                                                        'site_name': site_name,
-                                                        'name': file['title'],
-                                                        'lastModifiedDateTime': file['lastModifiedDateTime']
-                                                    })
-            if is_updated:
-                # delete documents that will get updated.
-                #deleted_docs = graph.delete_document(site_name, file['name'])
-                #logger.info("Deleted document(s): %s", deleted_docs)
-
-                downloaded = yield context.call_activity("download_file", {'file':file, 'run_id': run_id})
-                file['downloaded'] = downloaded
-                # Index files downloaded.
-                yield context.call_activity("index_file", {'file':file,
-                                                                     'run_id': run_id,
-                                                                     'site_name': site_name})
-                file['indexed'] = True
-    return [file for file in files if file['indexed']] # return only indexed files
+    max_concurrency = max(1, input_data.get("max_concurrency", _MAX_CONCURRENT_FILES))
+    batch_size = max(1, input_data.get("batch_size", _INDEX_BATCH_SIZE))
+    progress = {'page': cursor['page'] + 1, 'pages': cursor['pages']}
+
+    # only keep the files that are newer than what's in the index (or not in it yet), saved as the "index" page.
+    _set_status(context, "freshness", summary, progress)
+    stage_started = context.current_utc_datetime
+    count = yield context.call_activity("get_updated_files", {'site_name': site_name,
+                                                              'run_id': run_id,
+                                                              'page': cursor['page']})
+    metrics.add_stage(summary, "freshness", _elapsed(context, stage_started))
+    summary['files']['to_index'] += count
+    logger.info("Files of page %s that needs to be (re)indexed --> %s", cursor['page'], count)
+
+    # the groups are ranges of the page, the files themselves never go through the orchestration history.
+    groups = [{'site_name': site_name, 'run_id': run_id, 'page': cursor['page'], 'start': i,
+               'end': min(i + batch_size, count)} for i in range(0, count, batch_size)]
+    done = 0
+    for i in range(0, len(groups), max_concurrency):
+        _set_status(context, "indexing", summary, progress | {'done': done, 'total': count})
+        tasks = [context.call_sub_orchestrator("index_sharepoint_files", group)
+                 for group in groups[i:i + max_concurrency]]
+        outputs = yield context.task_all(tasks)
+        for output in outputs:
+            metrics.add_activity_metrics(summary, output['metrics'])
+            summary['files']['indexed'] += output['indexed']
+            summary['files']['failed'] += output['failed']
+            # the output only lists the first failures, all of them are in the results
+            cursor['failed'].extend(output['failures'][:max(0, _MAX_REPORTED_FAILURES - len(cursor['failed']))])
+        done = min(count, (i + max_concurrency) * batch_size)
+
+def _elapsed(context: DurableOrchestrationContext, since):
+    """Seconds since `since` as per the (replay safe) orchestration clock"""
+    return (context.current_utc_datetime - since).total_seconds()
+
+def _set_status(context: DurableOrchestrationContext, stage: str, summary: dict, progress: dict = None):
+    """Custom status of the orchestration, as returned by the durable status endpoint"""
+    context.set_custom_status({'stage': stage, 'summary': summary} | ({'progress': progress} if progress else {}))
+
+@app.orchestration_trigger(context_name="context")
+def index_sharepoint_files(context: DurableOrchestrationContext):
+    """
+    Index a group of files (the `start` to `end` range of a page of files to index) in a single batch.
+
+    If the batch fails, the files are indexed one at a time to find out which one(s) are failing. Never raises so
+    that one bad file doesn't abort the parent orchestration, errors are returned instead.
+
+    The index_files activities save the results of their files, the ones of the files whose activity failed are
+    saved by save_results. Returns the number of `indexed` and `failed` files, the first `failures` and the stages
+    `metrics` of the activities.
+    """
+    inputs = context.get_input()
+    output = {'indexed': 0, 'failed': 0, 'failures': [], 'metrics': {'stages': {}}}
+    try:
+        output = yield context.call_activity("index_files", inputs)
+    except Exception as e: # pylint: disable=broad-exception-caught
+        logger.warning("Unable to index files in batch, will index them one by one -> %s", e)
+        errors = {}
+        for position in range(inputs['start'], inputs['end']):
+            try:
+                file_output = yield context.call_activity("index_files", inputs | {'start': position,
+                                                                                   'end': position + 1})
+                _add_output(output, file_output)
+            except Exception as file_error: # pylint: disable=broad-exception-caught
+                logger.error("Unable to index file %s of page %s -> %s", position, inputs['page'], file_error)
+                errors[str(position)] = str(file_error)
+        if errors:
+            _add_output(output, (yield context.call_activity("save_results", inputs | {'errors': errors})))
+    return output
+
+def _add_output(output: dict, other: dict):
+    """Add the output of an index_files (or save_results) activity to the one of the group"""
+    output['indexed'] += other['indexed']
+    output['failed'] += other['failed']
+    output['failures'].extend(other['failures'][:max(0, _MAX_REPORTED_FAILURES - len(output['failures']))])
+    metrics.merge_activity_metrics(output['metrics'], other['metrics'])
+    return output
 
 @app.activity_trigger(input_name="sitename") # cannot use underscore for bindings, silly regex they have wont allow it
 async def get_sharepoint_site_info(sitename: str):
@@ -130,7 +509,9 @@ async def get_sharepoint_site_info(sitename: str):
     """
     url = f'{_domain}/:/sites/{sitename}'
     logger.info("Going to use this url to fetch site id and metadata: %s", url)
-    result = await _graph_client.sites.by_site_id(url).get()
+    # the sdk retries throttled calls itself, it still has to share the graph rate with the other calls.
+    await asyncio.to_thread(throttle.acquire, "graph")
+    result = await _get_graph_client().sites.by_site_id(url).get()
     return result.id
 
 @app.activity_trigger(input_name="inputs")
@@ -142,7 +523,8 @@ async def get_site_drive_url(inputs):
     _id = inputs['site_id'].split(',')[1]
     logger.info("The id used to retreive pages: %s", _id)
     # get drives https://graph.microsoft.com/v1.0/sites/{siteid}/drives
-    drives = await _graph_client.sites.by_site_id(_id).drives.get()
+    await asyncio.to_thread(throttle.acquire, "graph")
+    drives = await _get_graph_client().sites.by_site_id(_id).drives.get()
     filtered_drives = [drive for drive in drives.value if drive.odata_type== "#microsoft.graph.drive"]
 
     # Here we might receive something like Documents/SubfolderA/Some Other Folder/
@@ -162,105 +544,263 @@ async def get_site_drive_url(inputs):
     # graph API Since it doesn't do that sort of recursion.
     if len(drives_info) > 1:
         return graph.get_drives_info(
-            f"https://graph.microsoft.com/v1.0/drives/{drives_info[0]['drive_id']}/root/children",
-            _bearer_token_provider(),
+            f"{graph.GRAPH_API_ENDPOINT}/drives/{drives_info[0]['drive_id']}/root/children",
+            _get_graph_token(),
             drives_info[1:])
-    return f"https://graph.microsoft.com/v1.0/drives/{drives_info[0]['drive_id']}/root/children"
+    return f"{graph.GRAPH_API_ENDPOINT}/drives/{drives_info[0]['drive_id']}/root/children"
 
-@app.activity_trigger(input_name="url")
-async def get_files(url: str):
-    """Fetch a file at the url location.
+@app.activity_trigger(input_name="inputs")
+async def get_files(inputs):
+    """
+    Crawl the files of the drive folder at the `url` location into the manifest of the run.
 
-    Returns
-    ----------- 
-    Dict array {
+    Returns {'files': count, 'pages': manifest pages, 'results': where the results of the run are saved}, the
+    manifest pages hold the file dicts {
                 'downloadUrl': '@microsoft.graph.downloadUrl',
                 'title': 'name',
                 'url': 'webUrl',
                 'id': 'id',
-                'lastModifiedDateTime': 'lastModifiedDateTime'
-            } for each files
+                'lastModifiedDateTime': 'lastModifiedDateTime',
+                'size': 'size',
+                'driveId': 'parentReference.driveId'
+            } of each file
     """
-    return get_files_via_graph_call(url)
+    files = get_files_via_graph_call(inputs['url'])
+    return {'files': len(files),
+            'pages': storage.save_manifest(inputs['run_id'], "files", files),
+            'results': storage.manifest_prefix(inputs['run_id'], "results")}
 
 def get_files_via_graph_call(url: str):
-    """Recursive method that will get all the files from a folder and subfolder(s)"""
-    files = []
-    logger.info("Getting files and/or folders. Drive -> %s", url)
-    results = graph.call_graph_api(url, _bearer_token_provider())  # attribute_filter="@microsoft.graph.downloadUrl"
-    for result in results:
-        if result and '@microsoft.graph.downloadUrl' in result:
-            files.append({
-                'downloadUrl': result['@microsoft.graph.downloadUrl'],
-                'title': result['name'],
-                'url': result['webUrl'],
-                'id': result['id'],
-                'lastModifiedDateTime': result['lastModifiedDateTime']
-            })
-        if result and 'folder' in result:
-            logger.info("found folder: %s", result['name'])
-            if result['folder']['childCount'] == 0:
-                logger.info("folder is empty!")
-            else:
-                new_url = url.split('/items')[0]
-                new_url = new_url + f"/items/{result['id']}/children"
-                logger.info("NEW URL: %s", new_url)
-                files.extend(get_files_via_graph_call(new_url))
-    return files
-
+    """Get all the files from a folder and subfolder(s), see graph.list_drive_files"""
+    return graph.list_drive_files(url, _get_graph_token())
 
 @app.activity_trigger(input_name="inputs")
-def download_file(inputs):
-    """Download file to filesystem"""
-    url = inputs['file']['downloadUrl']
-    name = inputs['file']['title']
-    file_id = inputs['file']['id']
-    run_id = inputs['run_id']
+def get_changed_files(inputs):
+    """
+    Get the files added/updated and the ids of the files deleted since the last delta run for this site and scope
+    (drive or folder url), into the manifest of the run (see get_files). Returns the counts and pages of each, `full`
+    when the whole drive was enumerated.
 
+    The new delta state is saved as pending for this run, see commit_delta_state.
+    """
+    drive_id, folder_id = graph.parse_drive_url(inputs['url'])
+    state = storage.get_delta_state(inputs['site_name'], inputs['url'])
+    previous = storage.get_scope_ids(inputs['site_name'], inputs['url']) if state else None
+    known_ids = set(previous) if previous is not None else None
     try:
-        path = os.path.join(tempfile.gettempdir(), _DL_DIRECTORY, run_id)
-        if not os.path.exists(path):
-            os.makedirs(path)
-        with requests.get(url, stream=True, timeout=10) as r:
-            r.raise_for_status()
-            with open(os.path.join(path, file_id + _FILE_UNDERSCORE + name), 'wb') as f:
-                for chunk in r.iter_content(chunk_size=8192):
-                    f.write(chunk)
-        return True
-    except HTTPException as e:
-        logger.error("Unable to download file -> %s, %s", name, e)
-        return False
-    except OSError as e:
-        logger.error("Unable to write file -> %s, %s", name, e)
-        return False
+        changes = graph.get_drive_changes(drive_id, _get_graph_token(), state, folder_id, known_ids)
+    except graph.DeltaTokenExpiredError:
+        logger.warning("Delta token expired for site %s and drive %s, doing a full resync",
+                       inputs['site_name'],
+                       drive_id)
+        changes = graph.get_drive_changes(drive_id, _get_graph_token(), None, folder_id)
+    storage.save_delta_state(inputs['site_name'], inputs['url'], inputs['run_id'], changes['state'])
+    if known_ids is not None and not changes['full']:
+        # keep the ids of the scope up to date for the syncs (see sync_index) of the other scopes of the index.
+        ids = (known_ids | {file['id'] for file in changes['files']}) - set(changes['deleted'])
+        storage.save_scope_ids(inputs['site_name'], inputs['url'], sorted(ids))
+    return {'full': changes['full'],
+            'files': len(changes['files']),
+            'pages': storage.save_manifest(inputs['run_id'], "files", changes['files']),
+            'deleted': len(changes['deleted']),
+            'deleted_pages': storage.save_manifest(inputs['run_id'], "deleted", changes['deleted']),
+            'results': storage.manifest_prefix(inputs['run_id'], "results")}
 
+@app.activity_trigger(input_name="inputs")
+def commit_delta_state(inputs):
+    """Make the delta state of this run the starting point of the next delta run"""
+    return storage.commit_delta_state(inputs['site_name'], inputs['url'], inputs['run_id'])
+
+@app.activity_trigger(input_name="sitename")
+def create_index(sitename: str):
+    """Create the site index if it doesn't exists"""
+    return azure.create_index(sitename)
 
 @app.activity_trigger(input_name="inputs")
-def index_file(inputs):
-    """Loads all file from a specific folder and index them in a Azure Search Service"""
-    file = inputs['file']
-    run_id = inputs['run_id']
-    site_name = inputs['site_name']
-    path = os.path.join(tempfile.gettempdir(), _DL_DIRECTORY, run_id, file['id'] + _FILE_UNDERSCORE + file['title'])
+def sync_index(inputs):
+    """
+    Remove the chunks of the documents that are not in the drive anymore: the crawled files (manifest) are saved as
+    the ids of the scope (drive url), the doc ids of the chunks of the index are read through and the chunks of the
+    documents that are in none of the scopes of the site index are deleted by id. Returns the number of deleted
+    chunks.
+    """
+    ids = [file['id'] for page in range(inputs['pages'])
+           for file in storage.get_manifest_page(inputs['run_id'], "files", page)]
+    if not ids:
+        # more likely a listing issue than a drive emptied out, keep the index as it is.
+        logger.warning("No files crawled for site %s, not syncing its index", inputs['site_name'])
+        return 0
+    storage.save_scope_ids(inputs['site_name'], inputs['url'], ids)
+    orphans = azure.find_orphan_chunks(inputs['site_name'], storage.get_index_ids(inputs['site_name']))
+    # the other drives of the site may have saved their scope while the index was read, only delete what is still
+    # in none of the scopes (their chunks are uploaded after their scope is saved).
+    kept = storage.get_index_ids(inputs['site_name'])
+    return azure.delete_chunk_ids(inputs['site_name'], [chunk_id for doc_id, chunk_ids in orphans.items()
+                                                        if doc_id not in kept for chunk_id in chunk_ids])
 
-    # updated the code here to avoid timeout, this activity loads 1 file at the time
-    documents = SimpleDirectoryReader(input_files=[path], file_metadata=file_metadata).load_data()
-    documents[0].metadata = file # technically this dict (the file) represents the metadata we need.
-    #logger.info('Indexing file! %s (document(s) loaded: %s)', file, len(documents))
+@app.activity_trigger(input_name="inputs")
+def delete_documents(inputs):
+    """Remove the documents of a page of deleted ids of the manifest (graph item ids) from the site index"""
+    ids = storage.get_manifest_page(inputs['run_id'], "deleted", inputs['page'])
+    return graph.delete_documents(inputs['site_name'], ids)
+
+@app.activity_trigger(input_name="inputs")
+def index_files(inputs): # pylint: disable=too-many-locals,too-many-branches
+    """
+    Download and parse (in memory) a group of files then index them together, embeddings and uploads are done in
+    batches.
+
+    Files having the same content (graph hash and size) as an already indexed file are indexed by copying its chunks
+    instead, see util/dedupe.py. Within the group only the first file of a content is loaded, the others are copied
+    once it is indexed.
 
-    # create the index if it doesn't exists, otherwise just populate it for now.
-    # overwrite documents if metadata date is newer.
-    return azure.update_index_with_document(site_name, documents[0])
+    The files are read from the "index" page of the manifest (see get_updated_files), their results are saved in
+    the "results" pages. Returns {'indexed': count, 'failed': count, 'failures': the first failed files,
+    'metrics': the stages of the download, parse, embed, upload and copy measures, see metrics.Recorder}
+    """
+    site_name = inputs['site_name']
+    files = storage.get_manifest_page(inputs['run_id'], "index", inputs['page'])[inputs['start']:inputs['end']]
+    documents = []
+    errors = {}
+    recorder = metrics.Recorder()
+    sources = dedupe.find_sources(files) if dedupe.dedupe_enabled else {}
+    # ids of the chunks of every indexed file (loaded or copied)
+    chunk_ids = {}
+    to_load = []
+    copies = []
+    loaded_by_key = {}
+    for file in files:
+        if file['id'] in sources and _copy_file(file, sources[file['id']], site_name, recorder, errors, chunk_ids):
+            continue
+        key = dedupe.content_key(file) if dedupe.dedupe_enabled else None
+        if key and key in loaded_by_key:
+            copies.append((file, loaded_by_key[key]))
+            continue
+        if key:
+            loaded_by_key[key] = file
+        to_load.append(file)
+    for file in to_load:
+        try:
+            documents.extend(_load_documents(file, inputs['run_id'], recorder))
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logger.error("Unable to download/parse file -> %s, %s", file['title'], e)
+            errors[file['id']] = str(e)
+    logger.info("Indexing %s file(s), document(s) loaded: %s", len(to_load) - len(errors), len(documents))
+    loaded_ids = azure.update_index_with_documents(site_name, documents, recorder) if documents else {}
+    chunk_ids |= loaded_ids
+
+    entries = {}
+    if dedupe.dedupe_enabled:
+        for file in to_load:
+            if file['id'] in loaded_ids:
+                entries[file['id']] = dedupe.save_source(file, site_name, loaded_ids[file['id']])
+    for file, source in copies:
+        if entries.get(source['id']):
+            if not _copy_file(file, entries[source['id']], site_name, recorder, errors, chunk_ids):
+                errors[file['id']] = f"Chunks of {source['title']} not found in the index"
+        elif source['id'] in errors:
+            # same content as a file that failed, it would fail the same way.
+            errors[file['id']] = errors[source['id']]
+    # the chunks of the previous version of the updated files, in the same batched way.
+    with recorder.stage("upload"):
+        recorder.add("upload", "removed", azure.delete_replaced_chunks(site_name, chunk_ids))
+    logger.info("Throttling stats of this worker: %s", throttle.stats())
+    activity_metrics = recorder.to_dict()
+    return _save_results(inputs, files, errors, activity_metrics['files']) | {
+        'metrics': {'stages': activity_metrics['stages']}}
+
+def _save_results(inputs: dict, files: list[dict], errors: dict, file_metrics: dict):
+    """
+    Save the results ({'file', 'indexed'[, 'error']}, the file with its measures under `metrics`) of a group of
+    files as a "results" page of the manifest, returns the counts and the first failures.
+    """
+    results = []
+    for file in files:
+        file = {k: v for k, v in file.items() if k != 'downloadUrl'} | {'metrics': file_metrics.get(file['id'], {})}
+        results.append({'file': file, 'indexed': file['id'] not in errors} | ({'error': errors[file['id']]}
+                                                                              if file['id'] in errors else {}))
+    storage.save_manifest_page(inputs['run_id'], f"results/{inputs['page']:06d}", inputs['start'], results)
+    failures = [{k: result['file'][k] for k in ('id', 'title', 'url')} | {'error': result['error']}
+                for result in results if 'error' in result]
+    return {'indexed': len(results) - len(failures),
+            'failed': len(failures),
+            'failures': failures[:_MAX_REPORTED_FAILURES]}
+
+def _copy_file(file: dict, entry: dict, index_name: str, recorder: metrics.Recorder, errors: dict, # pylint: disable=too-many-arguments,too-many-positional-arguments
+               chunk_ids: dict):
+    """Index a file as a copy of the chunks of the dedupe entry, False if they are gone (the file is to be loaded)"""
+    try:
+        with recorder.stage("copy", file['id']), throttle.track() as counters:
+            copied = dedupe.copy_from_source(file, entry, index_name, _file_metadata(file))
+        recorder.add_throttling("copy", counters, file['id'])
+    except Exception as e: # pylint: disable=broad-exception-caught
+        logger.error("Unable to copy the chunks of %s for file -> %s, %s", entry['doc_id'], file['title'], e)
+        errors[file['id']] = str(e)
+        return True
+    if copied is None:
+        return False
+    chunk_ids[file['id']] = copied
+    recorder.add("copy", "copied", len(copied), file['id'])
+    return True
+
+def _file_metadata(file: dict):
+    """Metadata of the documents (and chunks) of a file"""
+    # technically the file dict represents the metadata we need.
+    return {key: file[key] for key in azure.METADATA_FIELDS}
+
+def _get_download_url(file: dict):
+    """New download url for a file, the one from the listing expires after a while"""
+    return graph.get_download_url(file['driveId'], file['id'], _get_graph_token())
+
+def _load_documents(file: dict, run_id: str, recorder: metrics.Recorder):
+    """Download and load the document(s) of a file (some readers return one per page) with the file as metadata"""
+    # don't download what won't be parsed.
+    parsing.check_size(file['title'], file.get('size'))
+    with ExitStack() as stack:
+        with recorder.stage("download", file['id']), throttle.track() as counters:
+            refresh_url = partial(_get_download_url, file) if file.get('driveId') else None
+            fs, path = stack.enter_context(download.downloaded_file(file, run_id, refresh_url))
+        recorder.add_throttling("download", counters, file['id'])
+        recorder.add("download", "bytes", fs.size(path) if fs else os.path.getsize(path), file['id'])
+        with recorder.stage("parse", file['id']):
+            documents = parsing.parse_file(path, fs)
+        recorder.add("parse", "documents", len(documents), file['id'])
+    for document in documents:
+        document.metadata = _file_metadata(file)
+        document.id_ = file['id'] # stored as the doc_id of every chunk, used to find them back.
+        # the chunks inherit them, only the content and title make the embedded text (and the cache key).
+        document.excluded_embed_metadata_keys = list(azure.EMBED_EXCLUDED_METADATA_FIELDS)
+        document.excluded_llm_metadata_keys = list(azure.EMBED_EXCLUDED_METADATA_FIELDS)
+    return documents
+
+@app.activity_trigger(input_name="runid")
+def cleanup_run(runid: str):
+    """Remove the files spilled to disk by this run (if any are left) and its manifest, the results excepted"""
+    download.cleanup_run(runid)
+    storage.delete_manifest(runid, ["files", "deleted", "index"])
+    return True
 
-def file_metadata(filename: str):
-    """pre-populate metadata with filename for later."""
-    metadata = azure.METADATA_FIELDS.copy()
-    # process the filename to remove the folders (if any)
-    basename = os.path.basename(filename)
-    metadata['title'] = basename.split(_FILE_UNDERSCORE)[1]
-    return metadata
+@app.activity_trigger(input_name="inputs")
+def get_updated_files(inputs):
+    """
+    Save the files of a page of the manifest that are either missing from the index or more recent than their
+    indexed version as the "index" page of the same number, returns how many there are.
+    """
+    files = storage.get_manifest_page(inputs['run_id'], "files", inputs['page'])
+    files = graph.get_updated_files(inputs['site_name'], files)
+    storage.save_manifest_page(inputs['run_id'], "index", inputs['page'], files)
+    return len(files)
 
 @app.activity_trigger(input_name="inputs")
-def is_document_updated(inputs):
-    """Checks wether or not a document is present in the index, and or needs updating."""
-    return graph.is_an_updated_document(inputs['site_name'], inputs['name'], inputs['lastModifiedDateTime'])
+def save_results(inputs):
+    """
+    Save the results of the files of a group whose index_files activity failed, `errors` by position in the page of
+    files to index. Returns the counts and failures like index_files does.
+    """
+    files = storage.get_manifest_page(inputs['run_id'], "index", inputs['page'])
+    output = {'indexed': 0, 'failed': 0, 'failures': [], 'metrics': {'stages': {}}}
+    for position, error in inputs['errors'].items():
+        file = files[int(position)]
+        _add_output(output, _save_results(inputs | {'start': int(position)}, [file], {file['id']: error}, {}) | {
+            'metrics': {'stages': {}}})
+    return output
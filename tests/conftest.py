@@ -0,0 +1,65 @@
+"""
+Fixtures running the indexer modules against the local stand-ins of fakes/ (graph and search servers, in-memory blob
+container). The settings are read when the modules are imported, the fixtures hand the modules out once they are set.
+"""
+# pylint: disable=redefined-outer-name
+import os
+from contextlib import ExitStack
+from types import SimpleNamespace
+
+import pytest
+
+from fakes.graph import FakeGraph, FakeGraphServer
+from fakes.search import FakeSearch, FakeSearchServer
+from fakes.storage import FakeContainerClient
+
+
+@pytest.fixture(scope="session")
+def servers():
+    """Fake graph and search servers for the whole session, the tests swap in their own drive and indexes"""
+    with ExitStack() as stack:
+        graph_server = stack.enter_context(FakeGraphServer(FakeGraph(0, 0)))
+        search_server = stack.enter_context(FakeSearchServer(FakeSearch()))
+        os.environ.update({
+            "GRAPH_API_ENDPOINT": graph_server.endpoint,
+            # the fakes don't throttle, no need to pace the calls
+            "THROTTLE_GRAPH_RATE": "1000",
+            "AZURE_SEARCH_SERVICE_ENDPOINT": search_server.endpoint,
+            "REQUESTS_CA_BUNDLE": search_server.certificate,
+            "AZURE_SEARCH_ADMIN_KEY": "fake-key",
+            "THROTTLE_SEARCH_RATE": "1000",
+            "EMBEDDING_CACHE": "none",
+        })
+        yield SimpleNamespace(graph=graph_server, search=search_server)
+
+
+@pytest.fixture
+def search(servers):
+    """Empty search service"""
+    servers.search.search = FakeSearch()
+    return servers.search.search
+
+
+@pytest.fixture
+def drive(servers):
+    """Drive of 4 folders (folder2 and folder3 being sub folders of folder0) holding 2 files each, root included"""
+    graph = FakeGraph(folders=4, files_per_folder=2, fanout=2)
+    graph.base_url = servers.graph.base_url
+    servers.graph.graph = graph
+    return graph
+
+
+@pytest.fixture
+def container(servers, monkeypatch): # pylint: disable=unused-argument
+    """In-memory blob container used by util/storage.py"""
+    from util import storage # pylint: disable=import-outside-toplevel
+    fake = FakeContainerClient()
+    monkeypatch.setattr(storage, "_get_container_client", lambda: fake)
+    return fake
+
+
+@pytest.fixture
+def modules(servers): # pylint: disable=unused-argument
+    """The util modules, imported once the settings point to the fakes"""
+    from util import azure, graph, storage # pylint: disable=import-outside-toplevel
+    return SimpleNamespace(azure=azure, graph=graph, storage=storage)
@@ -0,0 +1,32 @@
+"""
+Checks of the scope rules of a folder delta (util/graph.py get_drive_changes): which files are reported as changed
+and which ids as deleted when the rest of the drive changes too.
+"""
+
+
+def _file_ids(changes: dict):
+    return sorted(file["id"] for file in changes["files"])
+
+
+def test_folder_delta_only_reports_the_changes_of_its_scope(drive, modules):
+    """Files moved out or deleted under the folder are deleted, the changes of the rest of the drive are ignored"""
+    graph = modules.graph
+    first = graph.get_drive_changes(drive.drive_id, "fake-token", None, "folder0")
+    scope = sorted(item_id for item_id in drive.subtree("folder0") if "file" in item_id)
+    assert first["full"] and _file_ids(first) == scope and first["deleted"] == []
+
+    drive.update_file("folder0-file0")
+    drive.delete_item("folder2-file0")
+    drive.move_item("folder0-file1", "folder1")
+    drive.move_item("root-file0", "folder3")
+    # changes out of the folder
+    drive.update_file("folder1-file0")
+    drive.add_file("folder1", "new.txt")
+    drive.delete_item("folder1-file1")
+    drive.delete_item("root-file1")
+
+    second = graph.get_drive_changes(drive.drive_id, "fake-token", first["state"], "folder0", set(scope))
+
+    assert not second["full"]
+    assert _file_ids(second) == ["folder0-file0", "root-file0"]
+    assert sorted(second["deleted"]) == ["folder0-file1", "folder2-file0"]
@@ -0,0 +1,78 @@
+"""
+Checks of what the sync deletes from the index: the chunk reads over id ranges, the orphans of the site index (scopes
+of the other drives included) and the previous chunks of the re-indexed documents.
+"""
+import uuid
+
+import fakes.search
+
+
+def _create_index(search, name: str, chunks: list[dict]):
+    search.create_index({"name": name, "fields": [{"name": "id", "key": True}]})
+    search.index(name, [dict(chunk) for chunk in chunks])
+
+
+def _chunks(doc_id: str, count: int):
+    return [{"id": str(uuid.uuid4()), "doc_id": doc_id} for _ in range(count)]
+
+
+def _index_ids(search, name: str):
+    ids = {}
+    for chunk in search.indexes[name]["documents"].values():
+        ids.setdefault(chunk["doc_id"], set()).add(chunk["id"])
+    return ids
+
+
+def test_search_chunks_over_max_skip_reads_id_ranges(search, modules, monkeypatch):
+    """More matches than a search can skip through are read in id ranges, none is missed or read twice"""
+    # the service limits scaled down: 600 matches is over the skip limit, and so are the first ranges.
+    monkeypatch.setattr(fakes.search, "_MAX_SKIP", 20)
+    monkeypatch.setattr(fakes.search, "_MAX_PAGE_SIZE", 7)
+    monkeypatch.setattr(modules.azure, "_MAX_SKIP", 20)
+    chunks = [chunk for i in range(3) for chunk in _chunks(f"doc{i}", 200)]
+    _create_index(search, "site", chunks)
+
+    found = [chunk["id"] for chunk in modules.azure.search_chunks("site", None, ["id", "doc_id"])]
+    assert sorted(found) == sorted(chunk["id"] for chunk in chunks)
+    found = [chunk["id"] for chunk in modules.azure.search_chunks("site", "doc_id eq 'doc1'", ["id"])]
+    assert sorted(found) == sorted(chunk["id"] for chunk in chunks if chunk["doc_id"] == "doc1")
+
+    orphans = modules.azure.find_orphan_chunks("site", {"doc0", "doc2"})
+    assert {doc_id: set(ids) for doc_id, ids in orphans.items()} == {
+        "doc1": {chunk["id"] for chunk in chunks if chunk["doc_id"] == "doc1"}}
+
+
+def test_sync_index_keeps_the_chunks_of_a_scope_saved_meanwhile(search, container, modules, monkeypatch): # pylint: disable=unused-argument
+    """The documents of a drive whose scope is saved while the index is read are not deleted as orphans"""
+    import function_app # pylint: disable=import-outside-toplevel
+    from benchmarks.durable import LocalDurableRuntime # pylint: disable=import-outside-toplevel
+    storage, azure = modules.storage, modules.azure
+    _create_index(search, "site", _chunks("a1", 3) + _chunks("a2", 2) + _chunks("b1", 2) + _chunks("stray", 4))
+    storage.save_manifest("run", "files", [{"id": "a1"}, {"id": "a2"}])
+    find_orphan_chunks = azure.find_orphan_chunks
+
+    def find_while_drive_b_is_crawled(index_name, doc_ids):
+        orphans = find_orphan_chunks(index_name, doc_ids)
+        # the other drive of the site saves its scope after the index was read, then uploads b1.
+        storage.save_scope_ids("site", "https://graph/drives/b/root/children", ["b1"])
+        return orphans
+
+    monkeypatch.setattr(azure, "find_orphan_chunks", find_while_drive_b_is_crawled)
+    removed = LocalDurableRuntime(function_app).call_activity(
+        "sync_index", {"site_name": "site", "url": "https://graph/drives/a/root/children", "run_id": "run",
+                       "pages": 1})
+
+    assert removed == 4
+    assert set(_index_ids(search, "site")) == {"a1", "a2", "b1"}
+
+
+def test_delete_replaced_chunks_only_removes_the_previous_chunks(search, modules):
+    """The chunks of the previous version of a document are deleted, its new ones and the others are kept"""
+    previous, current, other = _chunks("a1", 3), _chunks("a1", 2), _chunks("a2", 2)
+    _create_index(search, "site", previous + current + other)
+
+    removed = modules.azure.delete_replaced_chunks("site", {"a1": [chunk["id"] for chunk in current]})
+
+    assert removed == 3
+    assert _index_ids(search, "site") == {"a1": {chunk["id"] for chunk in current},
+                                          "a2": {chunk["id"] for chunk in other}}
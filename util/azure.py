@@ -1,25 +1,47 @@
+from __future__ import annotations
+
+import json
 import logging
 import os
+import threading
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import cache
+from typing import TYPE_CHECKING
 
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
 from dotenv import load_dotenv
-from llama_index.core import StorageContext, VectorStoreIndex
-from llama_index.core.settings import Settings
-from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
-from llama_index.llms.azure_openai import AzureOpenAI
-from llama_index.vector_stores.azureaisearch import (AzureAISearchVectorStore,
-                                                     IndexManagement)
-from llama_index.core.schema import Document
 
-__all__ = ["get_search_client", "get_vector_store", "update_index_with_document"]
+from . import throttle
+from .metrics import Recorder
+
+if TYPE_CHECKING:
+    from llama_index.core.schema import Document
+
+__all__ = ["get_search_client",
+           "get_index_client",
+           "create_index",
+           "invalidate_index",
+           "get_embed_model",
+           "get_vector_store",
+           "update_index_with_document",
+           "update_index_with_documents",
+           "copy_document",
+           "search_chunks",
+           "delete_chunk_ids",
+           "delete_chunks",
+           "find_orphan_chunks",
+           "delete_replaced_chunks"]
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 load_dotenv()
 
+# NOTE: clients and llama_index are only loaded on first use, importing this module needs to stay cheap since every
+# worker (http trigger, orchestrators) loads it.
+
 azure_openai_uri: str   = os.getenv("AZURE_OPENAI_ENDPOINT", "UNDEFINED")
 api_key: str            = os.getenv("AZURE_OPENAI_API_KEY", "UNDEFINED")
 api_version: str        = os.getenv("AZURE_OPENAI_VERSION", "2024-05-01-preview")
@@ -27,35 +49,21 @@ api_version: str        = os.getenv("AZURE_OPENAI_VERSION", "2024-05-01-preview"
 service_endpoint: str   = os.getenv("AZURE_SEARCH_SERVICE_ENDPOINT", "UNDEFINED")
 search_key: str          = os.getenv("AZURE_SEARCH_ADMIN_KEY", "UNDEFINED")
 api_search_version: str = os.getenv("AZURE_SEARCH_VERSION", "2024-05-01-preview")
-search_key_credential = AzureKeyCredential(search_key)
-
-index_client = SearchIndexClient(
-        endpoint=service_endpoint,
-        credential=search_key_credential,
-        api_version=api_search_version
-    )
 
 openai_model: str = "gpt-35-turbo"
 embedding_model: str = "text-embedding-ada-002"
-
-llm = AzureOpenAI(
-    model=openai_model,
-    deployment_name=openai_model,
-    api_version=api_version,
-    azure_endpoint=azure_openai_uri,
-    api_key=api_key
-)
-
-embed_model = AzureOpenAIEmbedding(
-    model=embedding_model,
-    deployment_name=embedding_model,
-    api_key=api_key,
-    azure_endpoint=str(azure_openai_uri),
-    api_version=api_version
-)
-
-Settings.llm = llm
-Settings.embed_model = embed_model
+# how many chunks are sent per embedding request and uploaded per search index batch
+embed_batch_size: int   = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+upload_batch_size: int  = int(os.getenv("SEARCH_UPLOAD_BATCH_SIZE", "500"))
+# delete batches sent at once, each one holding up to _INDEX_BATCH_LIMIT actions
+delete_concurrency: int = int(os.getenv("SEARCH_DELETE_CONCURRENCY", "4"))
+# max actions of an indexing batch (service limit), a search can't skip more than _MAX_SKIP results.
+_INDEX_BATCH_LIMIT = 1000
+_MAX_SKIP = 100000
+# bytes of an upload batch, the service rejects requests over 16MB (the vector store caps its own to 14MB)
+_UPLOAD_MAX_BYTES = 14 * 1024 * 1024
+# ids per search.in, it is a lot cheaper than a long list of 'or' but the filter still has a size limit.
+SEARCH_IN_BATCH_SIZE = 500
 
 METADATA_FIELDS = {
         'title': 'name',
@@ -63,22 +71,97 @@ METADATA_FIELDS = {
         'id': 'id',
         'lastModifiedDateTime': 'lastModifiedDateTime'
     }
+# the graph item id is kept as the doc_id of the chunks, mapping it to 'id' would overwrite the chunk key.
+FILTERABLE_METADATA_FIELDS = [field for field in METADATA_FIELDS if field != 'id']
+# left out of the text that is embedded (and sent to the llm): they change on every edit and would make every chunk
+# of an updated document miss the embedding cache.
+EMBED_EXCLUDED_METADATA_FIELDS = ['url', 'id', 'lastModifiedDateTime']
 
-def get_search_client(index_name: str):
-    """Returns the search client for an Azure Search Service"""
-    return SearchClient(
+# clients and vector stores are cached per (lowercase) index name for the life of the worker process.
+_clients_lock = threading.RLock()
+_search_clients = {}
+_vector_stores = {}
+
+@cache
+def _get_search_key_credential():
+    from azure.core.credentials import AzureKeyCredential # pylint: disable=import-outside-toplevel
+    return AzureKeyCredential(search_key)
+
+@cache
+def get_index_client():
+    """Returns the (shared) search index client"""
+    from azure.search.documents.indexes import SearchIndexClient # pylint: disable=import-outside-toplevel
+    return SearchIndexClient(
         endpoint=service_endpoint,
-        index_name=index_name.lower(),
-        credential=search_key_credential
+        credential=_get_search_key_credential(),
+        api_version=api_search_version,
+        per_retry_policies=[throttle.search_policy()]
     )
 
-def get_vector_store(index_name: str):
-    """Retreive the vector store tied to an index or creates it if missing"""
+@cache
+def get_embed_model():
+    """
+    Returns the embedding model, also configures the llama_index Settings (llm and embed_model) the first time.
+    """
+    # pylint: disable=import-outside-toplevel
+    from llama_index.core.settings import Settings
+    from llama_index.embeddings.azure_openai import AzureOpenAIEmbedding
+    from llama_index.llms.azure_openai import AzureOpenAI
+
+    from .embedding_cache import create_embedding_cache
+
+    llm = AzureOpenAI(
+        model=openai_model,
+        deployment_name=openai_model,
+        api_version=api_version,
+        azure_endpoint=azure_openai_uri,
+        api_key=api_key,
+        http_client=throttle.openai_http_client()
+    )
+
+    embed_model = AzureOpenAIEmbedding(
+        model=embedding_model,
+        deployment_name=embedding_model,
+        api_key=api_key,
+        azure_endpoint=str(azure_openai_uri),
+        api_version=api_version,
+        embed_batch_size=embed_batch_size,
+        # the openai sdk retries throttled calls (honoring Retry-After), its client goes through our bucket.
+        http_client=throttle.openai_http_client(),
+        # chunks that were already embedded (i.e. unchanged parts of an updated document) are not sent again
+        embeddings_cache=create_embedding_cache(embedding_model)
+    )
+
+    Settings.llm = llm
+    Settings.embed_model = embed_model
+    return embed_model
+
+def get_search_client(index_name: str):
+    """Returns the (cached) search client for an index of the Azure Search Service"""
+    from azure.search.documents import SearchClient # pylint: disable=import-outside-toplevel
+    name = index_name.lower()
+    with _clients_lock:
+        if name not in _search_clients:
+            _search_clients[name] = SearchClient(
+                endpoint=service_endpoint,
+                index_name=name,
+                credential=_get_search_key_credential(),
+                per_retry_policies=[throttle.search_policy()]
+            )
+        return _search_clients[name]
+
+def _create_vector_store(index_name: str, create_if_not_exists: bool = False):
+    # pylint: disable=import-outside-toplevel
+    from llama_index.vector_stores.azureaisearch import (AzureAISearchVectorStore,
+                                                         IndexManagement)
+    # the index client is only needed to create the index, else the (cached and throttled) search client is used.
+    client = {"search_or_index_client": get_index_client(), "index_name": index_name.lower()} \
+        if create_if_not_exists else {"search_or_index_client": get_search_client(index_name)}
     return AzureAISearchVectorStore(
-        search_or_index_client=index_client,
-        filterable_metadata_field_keys=METADATA_FIELDS,
-        index_name=index_name.lower(),
-        index_management=IndexManagement.CREATE_IF_NOT_EXISTS,
+        **client,
+        filterable_metadata_field_keys=FILTERABLE_METADATA_FIELDS,
+        index_management=IndexManagement.CREATE_IF_NOT_EXISTS if create_if_not_exists
+                         else IndexManagement.NO_VALIDATION,
         id_field_key="id",
         chunk_field_key="chunk",
         embedding_field_key="embedding",
@@ -90,15 +173,236 @@ def get_vector_store(index_name: str):
         # compression_type="binary" # Option to use "scalar" or "binary". NOTE: compression is only supported for HNSW
     )
 
+def create_index(index_name: str):
+    """
+    Creates the index if it doesn't exists, meant to be called once per run before indexing documents.
+
+    The index is checked/created with the index client, the vector store of get_vector_store uses the search client.
+    """
+    _create_vector_store(index_name, create_if_not_exists=True)
+    return True
+
+def invalidate_index(index_name: str):
+    """Drop the cached clients of an index (i.e. after it was deleted or recreated)"""
+    with _clients_lock:
+        _search_clients.pop(index_name.lower(), None)
+        _vector_stores.pop(index_name.lower(), None)
+
+def get_vector_store(index_name: str):
+    """
+    Retreive the (cached) vector store tied to an index.
+
+    The index is not checked for existence on this path anymore, see create_index.
+    """
+    name = index_name.lower()
+    with _clients_lock:
+        if name not in _vector_stores:
+            _vector_stores[name] = _create_vector_store(name)
+        return _vector_stores[name]
+
 def update_index_with_document(index_name: str, document: Document):
     """
     Create or re-use index passed in and returns vector store tied to it.
     """
+    return update_index_with_documents(index_name, [document])
+
+def update_index_with_documents(index_name: str, documents: list[Document], recorder: Recorder = None): # pylint: disable=too-many-locals
+    """
+    Chunk, embed and upload many documents at once into the index passed in (created if missing).
+
+    Embeddings are requested `embed_batch_size` chunks at a time and uploaded `upload_batch_size` at a time. The
+    embed (chunking included) and upload stages are timed in the recorder, with the chunks and tokens embedded per
+    document and the chunks found in the embedding cache (`cached`).
+
+    Returns the ids of the uploaded chunks by document id.
+    """
+    # pylint: disable=import-outside-toplevel
+    from azure.core.exceptions import ResourceNotFoundError
+    from llama_index.core import StorageContext, VectorStoreIndex
+    from llama_index.core.indices.utils import embed_nodes
+    from llama_index.core.ingestion import run_transformations
+    from llama_index.core.schema import MetadataMode
+    from llama_index.core.settings import Settings
     logger.info("Using search service endpoint: %s", service_endpoint)
 
-    storage_context = StorageContext.from_defaults(vector_store=get_vector_store(index_name))
+    recorder = recorder or Recorder()
+    embed_model = get_embed_model()
+    embeddings_cache = embed_model.embeddings_cache
+    with recorder.stage("embed"), throttle.track() as counters, \
+            (embeddings_cache.track_misses() if embeddings_cache else nullcontext()) as missed:
+        nodes = run_transformations(documents, Settings.transformations)
+        embeddings = embed_nodes(nodes, embed_model)
+    recorder.add_throttling("embed", counters)
+    # only the chunks sent to the model count as embedded (and their tokens), the cache hits as `cached`.
+    volumes = defaultdict(lambda: {"chunks": 0, "tokens": 0, "cached": 0})
+    tokenizer = Settings.tokenizer
+    for node in nodes:
+        node.embedding = embeddings[node.node_id]
+        text = node.get_content(metadata_mode=MetadataMode.EMBED)
+        if missed is None or text in missed:
+            volumes[node.ref_doc_id]["chunks"] += 1
+            volumes[node.ref_doc_id]["tokens"] += len(tokenizer(text)) # pylint: disable=not-callable
+        else:
+            volumes[node.ref_doc_id]["cached"] += 1
+    for doc_id, measures in volumes.items():
+        for measure, value in measures.items():
+            if value:
+                recorder.add("embed", measure, value, doc_id)
 
-    index = VectorStoreIndex.from_documents([document], storage_context=storage_context)
+    # the nodes already have their embedding, the index only uploads them.
+    with recorder.stage("upload"), throttle.track() as counters:
+        try:
+            index = VectorStoreIndex(
+                nodes,
+                storage_context=StorageContext.from_defaults(vector_store=get_vector_store(index_name)),
+                embed_model=embed_model,
+                insert_batch_size=upload_batch_size)
+        except ResourceNotFoundError:
+            # the index was deleted since it was created/cached.
+            logger.warning("Index %s not found, recreating it", index_name)
+            invalidate_index(index_name)
+            create_index(index_name)
+            index = VectorStoreIndex(
+                nodes,
+                storage_context=StorageContext.from_defaults(vector_store=get_vector_store(index_name)),
+                embed_model=embed_model,
+                insert_batch_size=upload_batch_size)
+    recorder.add_throttling("upload", counters)
+    if embed_model.embeddings_cache:
+        logger.info("Embedding cache stats: %s", embed_model.embeddings_cache.stats())
+    chunk_ids = defaultdict(list)
     if index:
-        return True
-    return False
+        for node in nodes:
+            chunk_ids[node.ref_doc_id].append(node.node_id)
+    return dict(chunk_ids)
+
+def _copy_chunk(chunk: dict, ids: dict, source_doc_id: str, doc_id: str, metadata: dict):
+    """Copy of a chunk (as stored by the vector store) for another document, its node content included"""
+    node_metadata = json.loads(chunk['metadata'])
+    node = json.loads(node_metadata['_node_content'])
+    node['id_'] = ids[chunk['id']]
+    node['metadata'] = node.get('metadata', {}) | metadata
+    for relationship in node.get('relationships', {}).values():
+        # source document, previous and next chunks (lists are parent/child nodes, not used by our splitter)
+        if isinstance(relationship, dict):
+            if relationship.get('node_id') == source_doc_id:
+                relationship['node_id'] = doc_id
+                relationship['metadata'] = relationship.get('metadata', {}) | metadata
+            else:
+                relationship['node_id'] = ids.get(relationship.get('node_id'), relationship.get('node_id'))
+    node_metadata |= metadata | {'_node_content': json.dumps(node, ensure_ascii=False),
+                                 'document_id': doc_id, 'doc_id': doc_id, 'ref_doc_id': doc_id}
+    copy = {key: value for key, value in chunk.items() if not key.startswith('@')}
+    return copy | {'id': ids[chunk['id']], 'doc_id': doc_id, 'metadata': json.dumps(node_metadata)} | \
+        {field: metadata[field] for field in FILTERABLE_METADATA_FIELDS if field in metadata}
+
+def _upload_batches(documents: list[dict]):
+    """Split the documents in batches of `upload_batch_size` documents and _UPLOAD_MAX_BYTES (json) at most"""
+    batch, size = [], 0
+    for document in documents:
+        document_size = len(json.dumps(document).encode("utf-8"))
+        if batch and (len(batch) >= upload_batch_size or size + document_size > _UPLOAD_MAX_BYTES):
+            yield batch
+            batch, size = [], 0
+        batch.append(document)
+        size += document_size
+    if batch:
+        yield batch
+
+def copy_document(source: dict, index_name: str, doc_id: str, metadata: dict):
+    """
+    Index a document as a copy of the chunks (text and vectors) of an identical one, the `source` {'index', 'doc_id'
+    [, 'chunk_ids']} possibly being in another index, with its own id and metadata. Nothing is embedded.
+
+    Returns the ids of the new chunks, None if the source document has no chunks or not the expected `chunk_ids`.
+    """
+    source_index, source_doc_id = source['index'], source['doc_id']
+    chunks = list(get_search_client(source_index).search(search_text="*", filter=f"doc_id eq '{source_doc_id}'"))
+    if not chunks or ('chunk_ids' in source and {chunk['id'] for chunk in chunks} != set(source['chunk_ids'])):
+        return None
+    ids = {chunk['id']: str(uuid.uuid4()) for chunk in chunks}
+    documents = [_copy_chunk(chunk, ids, source_doc_id, doc_id, metadata) for chunk in chunks]
+    search_client = get_search_client(index_name)
+    for batch in _upload_batches(documents):
+        search_client.upload_documents(documents=batch)
+    logger.info("Copied %s chunk(s) of document %s (index %s) as document %s", len(documents), source_doc_id,
+                source_index, doc_id)
+    return list(ids.values())
+
+def _search_chunks(search_client, odata_filter: str, select: list[str], bounds: tuple = (None, None, "")):
+    """
+    See search_chunks, `bounds` is the (low, high, prefix) range of chunk ids to read: above _MAX_SKIP matches, a
+    range is split in 16 on the next character of the ids (uuids) and each part is read on its own.
+    """
+    low, high, prefix = bounds
+    clauses = [odata_filter] if odata_filter else []
+    clauses += [f"id ge '{low}'"] if low else []
+    clauses += [f"id lt '{high}'"] if high else []
+    # a top that big is served 1000 results per request, following the continuations.
+    results = search_client.search(search_text="*", filter=" and ".join(clauses) or None, select=select,
+                                   top=_MAX_SKIP, include_total_count=True)
+    if results.get_count() <= _MAX_SKIP:
+        yield from results
+        return
+    characters = "0123456789abcdef"
+    for i, character in enumerate(characters):
+        yield from _search_chunks(search_client, odata_filter, select,
+                                  (low if i == 0 else prefix + character,
+                                   high if i == len(characters) - 1 else prefix + characters[i + 1],
+                                   prefix + character))
+
+def search_chunks(index_name: str, odata_filter: str, select: list[str]):
+    """
+    Yields every chunk matching the filter (None for all of them) with the `select` fields, read 1000 at a time
+    whatever their number: searches can't skip more than _MAX_SKIP results so bigger results are read in ranges of
+    chunk ids.
+
+    There is no order (the fields are not sortable), chunks written meanwhile may be missed or read twice.
+    """
+    return _search_chunks(get_search_client(index_name), odata_filter, select)
+
+def delete_chunk_ids(index_name: str, chunk_ids: list[str]):
+    """
+    Delete chunks by id in batches of 1000 actions, `delete_concurrency` batches at once. Returns the number of
+    deleted chunks.
+    """
+    search_client = get_search_client(index_name)
+    batches = [chunk_ids[i:i + _INDEX_BATCH_LIMIT] for i in range(0, len(chunk_ids), _INDEX_BATCH_LIMIT)]
+    if batches:
+        with ThreadPoolExecutor(max_workers=min(delete_concurrency, len(batches))) as executor:
+            # list() to raise the first error
+            list(executor.map(lambda batch: search_client.delete_documents(documents=[{"id": chunk_id}
+                                                                                      for chunk_id in batch]),
+                              batches))
+    return len(chunk_ids)
+
+def delete_chunks(index_name: str, odata_filter: str):
+    """Delete all the chunks matching the filter, see search_chunks and delete_chunk_ids"""
+    return delete_chunk_ids(index_name, [chunk['id'] for chunk in search_chunks(index_name, odata_filter, ["id"])])
+
+def find_orphan_chunks(index_name: str, doc_ids: set[str]):
+    """
+    Read the doc_id of every chunk of the index and returns the ids of the chunks of the documents that are not one
+    of doc_ids, by document: {doc_id: [chunk ids]}.
+    """
+    orphans = defaultdict(list)
+    for chunk in search_chunks(index_name, None, ["id", "doc_id"]):
+        if chunk['doc_id'] not in doc_ids:
+            orphans[chunk['doc_id']].append(chunk['id'])
+    logger.info("Found %s orphan chunk(s) of %s document(s) in index %s", sum(map(len, orphans.values())),
+                len(orphans), index_name)
+    return dict(orphans)
+
+def delete_replaced_chunks(index_name: str, chunk_ids: dict[str, list[str]]):
+    """
+    Delete the chunks of the documents (by doc_id) that are not their current ones, i.e. the ones left over from
+    the previous version of a re-indexed document. Returns the number of deleted chunks.
+    """
+    current = {chunk_id for ids in chunk_ids.values() for chunk_id in ids}
+    doc_ids = list(chunk_ids)
+    replaced = []
+    for i in range(0, len(doc_ids), SEARCH_IN_BATCH_SIZE):
+        odata_filter = f"search.in(doc_id, '{','.join(doc_ids[i:i + SEARCH_IN_BATCH_SIZE])}', ',')"
+        replaced.extend(chunk['id'] for chunk in search_chunks(index_name, odata_filter, ["id"])
+                        if chunk['id'] not in current)
+    return delete_chunk_ids(index_name, replaced)
@@ -0,0 +1,55 @@
+import base64
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from . import azure, storage
+
+__all__ = ["dedupe_enabled", "content_key", "find_sources", "save_source", "copy_from_source"]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# files having the same content as an already indexed one get a copy of its chunks (and vectors) instead of being
+# downloaded, parsed and embedded again, the content is identified by the graph quickXorHash and size.
+dedupe_enabled: bool = os.getenv("DEDUPE_CONTENT", "true").lower() == "true"
+# dedupe entries looked up at once
+_LOOKUP_CONCURRENCY = 8
+
+def content_key(file: dict):
+    """Key of the content of a file, None if graph didn't give us its hash"""
+    if not file.get('hash') or file.get('size') is None:
+        return None
+    # the hash is base64, make it a valid blob name.
+    digest = base64.urlsafe_b64encode(base64.b64decode(file['hash'])).decode().rstrip('=')
+    return f"{file['size']}-{digest}"
+
+def find_sources(files: list[dict]):
+    """Returns the dedupe entry of the files whose content is already indexed, by file id"""
+    keys = {file['id']: content_key(file) for file in files}
+    unique = list({key for key in keys.values() if key})
+    if not unique:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(_LOOKUP_CONCURRENCY, len(unique))) as executor:
+        entries = dict(zip(unique, executor.map(storage.get_dedupe_entry, unique)))
+    return {file_id: entries[key] for file_id, key in keys.items() if key and entries[key]}
+
+def save_source(file: dict, index_name: str, chunk_ids: list[str]):
+    """Record that the content of the file is indexed as these chunks, returns the entry (None without hash)"""
+    key = content_key(file)
+    if not key or not chunk_ids:
+        return None
+    entry = {'index': index_name.lower(), 'doc_id': file['id'], 'chunk_ids': chunk_ids}
+    storage.save_dedupe_entry(key, entry)
+    return entry
+
+def copy_from_source(file: dict, entry: dict, index_name: str, metadata: dict):
+    """
+    Index the file as a copy of the chunks of the entry, returns the new chunk ids. None if the source document
+    doesn't have the chunks of the entry anymore (deleted or re-indexed), the entry is then dropped.
+    """
+    chunk_ids = azure.copy_document(entry, index_name, file['id'], metadata)
+    if chunk_ids is None:
+        logger.info("Source of %s (%s) is gone from index %s", file['title'], entry['doc_id'], entry['index'])
+        storage.delete_dedupe_entry(content_key(file))
+    return chunk_ids
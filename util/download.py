@@ -0,0 +1,204 @@
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import throttle
+
+__all__ = ["DL_DIRECTORY", "FILE_UNDERSCORE", "get_run_directory", "downloaded_file", "cleanup_run"]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+DL_DIRECTORY = "sharepoint_indexer"
+FILE_UNDERSCORE = "___"
+# files bigger than this are spilled to disk instead of being kept in memory
+in_memory_max_size: int = int(os.getenv("IN_MEMORY_MAX_SIZE", str(32 * 1024 * 1024)))
+# files bigger than this (graph listing size) are downloaded in ranges of `range_size` bytes, `range_workers` at once
+ranged_min_size: int = int(os.getenv("RANGED_DOWNLOAD_MIN_SIZE", str(64 * 1024 * 1024)))
+range_size: int = int(os.getenv("DOWNLOAD_RANGE_SIZE", str(8 * 1024 * 1024)))
+range_workers: int = int(os.getenv("DOWNLOAD_RANGE_WORKERS", "4"))
+# how many times a range is resumed (from the last byte received) before its pass fails, and how many passes over
+# the missing ranges are done before the download fails
+range_attempts: int = int(os.getenv("DOWNLOAD_RANGE_ATTEMPTS", "5"))
+ranged_download_passes: int = int(os.getenv("RANGED_DOWNLOAD_PASSES", "3"))
+# (connect, read) timeouts, the read timeout is between two packets, not for the whole file
+_TIMEOUT = (10, int(os.getenv("DOWNLOAD_READ_TIMEOUT", "30")))
+_CHUNK_SIZE = 64 * 1024
+# what SharePoint answers once a pre-authenticated download url expired
+_EXPIRED_STATUS = {401, 403}
+# errors after which a range is resumed
+_RESUMABLE_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# shared session so downloads re-use connections, enough of them for the ranges of a few files at once
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv("DOWNLOAD_POOL_SIZE", "32")))
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+class _DownloadUrl: # pylint: disable=too-few-public-methods
+    """The download url of a file, requested again (through `refresh`) when SharePoint refuses it"""
+    def __init__(self, url: str, refresh=None):
+        self.url = url
+        self._refresh = refresh
+        self._lock = threading.Lock()
+
+    def get(self, **kwargs):
+        """GET the url through the download throttle, with a new url if it expired"""
+        url = self.url
+        r = throttle.request("download", "GET", url, session=_session, timeout=_TIMEOUT, **kwargs)
+        if r.status_code in _EXPIRED_STATUS and self._refresh:
+            r.close()
+            with self._lock:
+                # the ranges downloaded at once all get refused, only the first one asks for a new url.
+                if self.url == url:
+                    logger.info("Download url expired (%s), requesting a new one", r.status_code)
+                    self.url = self._refresh()
+            r = throttle.request("download", "GET", self.url, session=_session, timeout=_TIMEOUT, **kwargs)
+        return r
+
+class _RangeNotSupportedError(Exception):
+    """The server answered a range request with the whole file"""
+
+def get_run_directory(run_id: str):
+    """Local directory where the files of a run are spilled to disk"""
+    return os.path.join(tempfile.gettempdir(), DL_DIRECTORY, run_id)
+
+def _file_name(file: dict):
+    # the file id prefix is used to avoid collisions, see file_metadata in function_app
+    return file['id'] + FILE_UNDERSCORE + file['title']
+
+def _download_range(download_url: _DownloadUrl, path: str, start: int, end: int):
+    """Download the bytes start..end (inclusive) at the same offset of path, resuming from the last byte received"""
+    position = start
+    attempts = 0
+    with open(path, 'r+b') as f:
+        while position <= end:
+            try:
+                with download_url.get(headers={'Range': f"bytes={position}-{end}"}, stream=True) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise _RangeNotSupportedError(f"{r.status_code} answered to a range request")
+                    f.seek(position)
+                    for chunk in r.iter_content(chunk_size=_CHUNK_SIZE):
+                        f.write(chunk[:end + 1 - position])
+                        position += len(chunk)
+            except _RESUMABLE_ERRORS as e:
+                attempts += 1
+                if attempts >= range_attempts:
+                    raise
+                logger.warning("Range %s-%s of %s interrupted at %s, resuming: %s", start, end, path, position, e)
+
+def _ranged_download(file: dict, path: str, download_url: _DownloadUrl):
+    """
+    Download a (large) file in ranges written in place, at once over the pooled connections.
+
+    When a range fails, the other ones are completed and the missing ones are downloaded again in another pass (on
+    the same instance), up to `ranged_download_passes` passes.
+    """
+    size = file['size']
+    with open(path, 'wb') as f:
+        f.truncate(size)
+    done = set()
+    lock = threading.Lock()
+
+    def download(start: int):
+        _download_range(download_url, path, start, min(start + range_size, size) - 1)
+        with lock:
+            done.add(start)
+
+    for attempt in range(1, ranged_download_passes + 1):
+        starts = [start for start in range(0, size, range_size) if start not in done]
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(range_workers, len(starts)))) as executor:
+                futures = [executor.submit(download, start) for start in starts]
+                # raises the first error once the executor waited for the other ranges
+                for future in futures:
+                    future.result()
+            break
+        except (requests.RequestException, OSError) as e:
+            if attempt == ranged_download_passes:
+                raise
+            logger.warning("Download of %s failed with %s range(s) missing, downloading them again: %s",
+                           file['title'], len(starts) - len(done.intersection(starts)), e)
+    logger.info("File %s downloaded in %s range(s) (%s bytes)", file['title'], len(done), size)
+
+@contextmanager
+def downloaded_file(file: dict, run_id: str, refresh_url=None): # pylint: disable=too-many-branches
+    """
+    Download a file and yields (fs, path) to read it with a SimpleDirectoryReader.
+
+    The file is kept in memory (fs is an fsspec memory filesystem) unless it is bigger than `in_memory_max_size`,
+    then it is written in the run directory (fs is None, the local filesystem). Either way it is removed on exit.
+    Files of more than `ranged_min_size` bytes (as listed by graph) are downloaded in ranges to the run directory.
+    `refresh_url` returns a new download url for the file, it is called when the one we have expired.
+    """
+    # pylint: disable=import-outside-toplevel
+    from fsspec.implementations.memory import MemoryFileSystem
+
+    download_url = _DownloadUrl(file['downloadUrl'], refresh_url)
+    path = os.path.join(get_run_directory(run_id), _file_name(file))
+    if (file.get('size') or 0) > ranged_min_size:
+        os.makedirs(get_run_directory(run_id), exist_ok=True)
+        try:
+            _ranged_download(file, path, download_url)
+        except _RangeNotSupportedError as e:
+            logger.warning("Ranged download of %s not possible (%s), downloading it at once", file['title'], e)
+            os.remove(path)
+        except BaseException:
+            # don't leave a partial file of that size behind, the run directory is only removed if the run succeeds.
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        else:
+            try:
+                yield None, path
+            finally:
+                os.remove(path)
+            return
+
+    buffer = io.BytesIO()
+    spilled = None
+    try:
+        with download_url.get(stream=True) as r:
+            r.raise_for_status()
+            if int(r.headers.get('Content-Length', 0)) > in_memory_max_size:
+                os.makedirs(get_run_directory(run_id), exist_ok=True)
+                spilled = open(path, 'wb') # pylint: disable=consider-using-with
+            for chunk in r.iter_content(chunk_size=_CHUNK_SIZE):
+                if spilled is None and buffer.tell() + len(chunk) > in_memory_max_size:
+                    # no (or wrong) content length, spill what we have so far.
+                    os.makedirs(get_run_directory(run_id), exist_ok=True)
+                    spilled = open(path, 'wb') # pylint: disable=consider-using-with
+                    spilled.write(buffer.getvalue())
+                    buffer = io.BytesIO()
+                (spilled or buffer).write(chunk)
+        if spilled:
+            spilled.close()
+            logger.info("File %s spilled to disk (%s bytes)", file['title'], os.path.getsize(path))
+            yield None, path
+        else:
+            fs = MemoryFileSystem()
+            fs.pipe(path, buffer.getvalue())
+            buffer = None
+            try:
+                yield fs, path
+            finally:
+                # the memory filesystem store is shared by the whole process.
+                fs.rm(path)
+    finally:
+        if spilled:
+            spilled.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+def cleanup_run(run_id: str):
+    """Remove whatever is left from a run in the local directory"""
+    shutil.rmtree(get_run_directory(run_id), ignore_errors=True)
@@ -0,0 +1,202 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import abstractmethod
+from array import array
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient
+from llama_index.core.storage.kvstore.types import DEFAULT_COLLECTION, BaseKVStore
+
+from .storage import blob_connection_string, blob_container_name
+
+__all__ = ["EmbeddingCache", "SQLiteEmbeddingCache", "BlobEmbeddingCache", "create_embedding_cache"]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+embedding_cache_backend: str  = os.getenv("EMBEDDING_CACHE", "sqlite")
+embedding_cache_path: str     = os.getenv("EMBEDDING_CACHE_PATH",
+                                          os.path.join(tempfile.gettempdir(), "sharepoint_indexer", "embeddings.db"))
+# size of the vectors kept in the sqlite file (1536 float32 take 6KB), it is on the local temp disk of the instance.
+embedding_cache_max_mb: int   = int(os.getenv("EMBEDDING_CACHE_MAX_MB", "100"))
+
+class EmbeddingCache(BaseKVStore):
+    """
+    Key-value store to plug in the `embeddings_cache` of an embedding model.
+
+    The model calls it with the chunk text as the key, entries are stored under a hash of (model, text) so that
+    unchanged chunks are never embedded twice, and switching model doesn't return stale vectors.
+    Embeddings are stored as float32.
+    """
+    def __init__(self, model: str):
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._tracked = threading.local()
+
+    def _hash(self, key: str):
+        return hashlib.sha256(f"{self.model}\n{key}".encode()).hexdigest()
+
+    @abstractmethod
+    def _load(self, key_hash: str) -> Optional[bytes]:
+        """Stored embedding of the hash, None if there is none"""
+
+    @abstractmethod
+    def _save(self, key_hash: str, embedding: bytes):
+        """Store the embedding of the hash"""
+
+    @abstractmethod
+    def _remove(self, key_hash: str) -> bool:
+        """Remove the embedding of the hash, False if there was none"""
+
+    def stats(self):
+        """Returns the hit/miss/eviction counters"""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    @contextmanager
+    def track_misses(self):
+        """Collect the keys (texts) missed by the calls of the current thread within the block, the ones embedded"""
+        self._tracked.misses = missed = set()
+        try:
+            yield missed
+        finally:
+            self._tracked.misses = None
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        # the model stores a dict of {some_id: embedding}
+        embedding = next(iter(val.values()))
+        self._save(self._hash(key), array('f', embedding).tobytes())
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.put(key, val, collection)
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        data = self._load(self._hash(key))
+        if data is None:
+            self.misses += 1
+            missed = getattr(self._tracked, "misses", None)
+            if missed is not None:
+                missed.add(key)
+            return None
+        self.hits += 1
+        embedding = array('f')
+        embedding.frombytes(data)
+        return {"embedding": embedding.tolist()}
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.get(key, collection)
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        # entries are stored by hash, the texts can't be listed back.
+        return {}
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.get_all(collection)
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self._remove(self._hash(key))
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.delete(key, collection)
+
+
+class SQLiteEmbeddingCache(EmbeddingCache):
+    """
+    Local SQLite file cache, bounded to max_mb of embeddings: the least recently used entries are evicted (10% at a
+    time) once it is full.
+    """
+    def __init__(self, model: str, path: str = embedding_cache_path, max_mb: int = embedding_cache_max_mb):
+        super().__init__(model)
+        self.max_bytes = max_mb * 1024 * 1024
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                                 "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._count, self._bytes = self._size()
+
+    def _size(self):
+        return self._connection.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(embedding)), 0) "
+                                        "FROM embeddings").fetchone()
+
+    def _load(self, key_hash: str):
+        with self._lock:
+            row = self._connection.execute("SELECT embedding FROM embeddings WHERE key = ?", (key_hash,)).fetchone()
+            if row:
+                self._connection.execute("UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key_hash))
+                return row[0]
+            return None
+
+    def _save(self, key_hash: str, embedding: bytes):
+        with self._lock:
+            cursor = self._connection.execute("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                                              (key_hash, embedding, time.time()))
+            self._count += cursor.rowcount
+            self._bytes += len(embedding)
+            if self._bytes > self.max_bytes:
+                evicted = self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (max(1, self._count // 10),)).rowcount
+                self.evictions += evicted
+                self._count, self._bytes = self._size()
+
+    def _remove(self, key_hash: str):
+        with self._lock:
+            removed = self._connection.execute("DELETE FROM embeddings WHERE key = ?", (key_hash,)).rowcount
+            if removed:
+                self._count, self._bytes = self._size()
+            return removed > 0
+
+
+class BlobEmbeddingCache(EmbeddingCache):
+    """
+    Cache shared by all the instances in a blob container (one blob per entry under embeddings/<model>/).
+
+    There is no eviction done here, size it with a lifecycle management rule on the container instead
+    (e.g. delete blobs not accessed for 90 days).
+    """
+    def __init__(self, model: str, connection_string: str, container_name: str):
+        super().__init__(model)
+        self._container = BlobServiceClient.from_connection_string(connection_string) \
+                                           .get_container_client(container_name)
+
+    def _blob_name(self, key_hash: str):
+        return f"embeddings/{self.model}/{key_hash}"
+
+    def _load(self, key_hash: str):
+        try:
+            return self._container.download_blob(self._blob_name(key_hash)).readall()
+        except ResourceNotFoundError:
+            return None
+
+    def _save(self, key_hash: str, embedding: bytes):
+        self._container.upload_blob(self._blob_name(key_hash), embedding, overwrite=True)
+
+    def _remove(self, key_hash: str):
+        try:
+            self._container.delete_blob(self._blob_name(key_hash))
+            return True
+        except ResourceNotFoundError:
+            return False
+
+
+def create_embedding_cache(model: str, backend: str = embedding_cache_backend):
+    """Returns the cache configured via EMBEDDING_CACHE (sqlite, blob or none)"""
+    if backend == "sqlite":
+        logger.info("Using sqlite embedding cache: %s", embedding_cache_path)
+        return SQLiteEmbeddingCache(model)
+    if backend == "blob":
+        logger.info("Using blob storage embedding cache")
+        return BlobEmbeddingCache(model, blob_connection_string, blob_container_name)
+    return None
@@ -1,37 +1,249 @@
 import logging
+import os
 import re
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime as dt
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from .azure import get_search_client
+from . import throttle
+from .azure import SEARCH_IN_BATCH_SIZE, delete_chunks, get_search_client, search_chunks
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-__all__ = ["call_graph_api",
+__all__ = ["GRAPH_API_ENDPOINT",
+        "DRIVE_ITEM_FIELDS",
+        "PAGE_SIZE",
+        "DeltaTokenExpiredError",
+        "call_graph_api",
+        "file_info",
+        "get_download_url",
+        "list_drive_files",
+        "parse_drive_url",
+        "get_drive_changes",
         "get_drives_info",
         "is_an_updated_document",
-        "delete_document"]
+        "get_updated_files",
+        "delete_document",
+        "delete_documents"]
+
+# can be pointed to a local stand-in server for testing (see fakes/graph.py)
+GRAPH_API_ENDPOINT: str = os.getenv("GRAPH_API_ENDPOINT", "https://graph.microsoft.com/v1.0").rstrip('/')
+
+# only the fields we actually use from the drive items (see file_info and get_files_via_graph_call)
+DRIVE_ITEM_FIELDS = ["id", "name", "webUrl", "lastModifiedDateTime", "size", "folder", "file",
+                     "@microsoft.graph.downloadUrl"]
+# max page size graph accepts for drive items listing
+PAGE_SIZE = 999
+# how many folders are listed at once when crawling a drive
+LIST_CONCURRENCY = int(os.getenv("GRAPH_LIST_CONCURRENCY", "8"))
+
+# shared session so calls re-use connections (and TLS handshakes) instead of opening a new one each time
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv("GRAPH_POOL_SIZE", "32")))
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+class DeltaTokenExpiredError(Exception):
+    """Raised when graph refuses a delta link (expired/invalid token), a full resync is then required"""
 
 def call_graph_api(url: str, token: str, **kwargs):
     """
     Calls the graph API. Would use the client but it doesn't support our use case for drilling down folders *yet*
+
+    Generator that yields the items of each page as they come in, following the `@odata.nextLink` until the last
+    page. Pass `select` (list of fields) and/or `top` (page size) to reduce what graph sends back.
     """
     odata_filter = kwargs.get('odata_filter', None)
     attribute_filter = kwargs.get('attribute_filter', None)
+    params = {}
+    if kwargs.get('select'):
+        params['$select'] = ','.join(kwargs['select'])
+    if kwargs.get('top'):
+        params['$top'] = kwargs['top']
     headers = {
         'Accept': '*/*',
         "Authorization": f"Bearer {token}"
     }
-    r = requests.get(url, headers=headers, timeout=10)
+    while url:
+        r = throttle.request("graph", "GET", url, session=_session, headers=headers, params=params, timeout=10)
+        r.raise_for_status()
+        page = r.json()
+        for item in page['value']:
+            if odata_filter and item['odata_type'] != odata_filter:
+                continue
+            if attribute_filter and attribute_filter not in item:
+                continue
+            yield item
+        # the next link already contains the query parameters
+        url = page.get('@odata.nextLink')
+        params = None
+
+def file_info(item: dict, drive_id: str = None):
+    """
+    Returns the file dict we carry around (and use as metadata) for a drive item.
+
+    The size and drive id are used by the downloads (ranged downloads of large files, new download url when it
+    expired), the size and hash (quickXorHash) to find copies of already indexed files. They are not indexed.
+    """
+    return {
+        'downloadUrl': item['@microsoft.graph.downloadUrl'],
+        'title': item['name'],
+        'url': item['webUrl'],
+        'id': item['id'],
+        'lastModifiedDateTime': item['lastModifiedDateTime'],
+        'size': item.get('size'),
+        'hash': item.get('file', {}).get('hashes', {}).get('quickXorHash'),
+        'driveId': drive_id or item.get('parentReference', {}).get('driveId')
+    }
+
+def get_download_url(drive_id: str, item_id: str, token: str):
+    """Request a new (pre-authenticated, short lived) download url for a drive item"""
+    r = throttle.request("graph", "GET", f"{GRAPH_API_ENDPOINT}/drives/{drive_id}/items/{item_id}",
+                         session=_session, headers={"Authorization": f"Bearer {token}"},
+                         params={'$select': 'id,@microsoft.graph.downloadUrl'}, timeout=10)
     r.raise_for_status()
-    result = r.json()['value']
-    if odata_filter:
-        result = [item for item in result if item['odata_type'] == odata_filter]
-    if attribute_filter:
-        result = [item for item in result if attribute_filter in item]
-    return result
+    return r.json()['@microsoft.graph.downloadUrl']
+
+def _list_folder(url: str, token: str):
+    """
+    List a single folder, returns its entries in order: a file dict for files and the children url for
+    (non empty) sub folders.
+    """
+    entries = []
+    drive_id = parse_drive_url(url)[0] if '/drives/' in url else None
+    logger.info("Getting files and/or folders. Drive -> %s", url)
+    for result in call_graph_api(url, token, select=DRIVE_ITEM_FIELDS, top=PAGE_SIZE):
+        if result and '@microsoft.graph.downloadUrl' in result:
+            entries.append(file_info(result, drive_id))
+        if result and 'folder' in result:
+            logger.info("found folder: %s", result['name'])
+            if result['folder']['childCount'] == 0:
+                logger.info("folder is empty!")
+            else:
+                entries.append(url.split('/items')[0] + f"/items/{result['id']}/children")
+    return entries
+
+def list_drive_files(url: str, token: str, max_workers: int = LIST_CONCURRENCY):
+    """
+    Get all the files from a folder and its subfolder(s).
+
+    Folders are listed breadth first, up to max_workers at once, the files are then returned in the same order a
+    depth first walk of the folders would have.
+    """
+    listings = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        pending = {executor.submit(_list_folder, url, token): url}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder_url = pending.pop(future)
+                listings[folder_url] = future.result()
+                for entry in listings[folder_url]:
+                    if isinstance(entry, str):
+                        pending[executor.submit(_list_folder, entry, token)] = entry
+
+    files = []
+    stack = [iter(listings[url])]
+    while stack:
+        entry = next(stack[-1], None)
+        if entry is None:
+            stack.pop()
+        elif isinstance(entry, str):
+            stack.append(iter(listings[entry]))
+        else:
+            files.append(entry)
+    return files
+
+def parse_drive_url(url: str):
+    """
+    Split a drive children url (as returned by get_site_drive_url) into its drive id and folder id.
+
+    The folder id is None when the url is pointing to the root of the drive.
+    """
+    match = re.search(r'/drives/([^/]+)/(?:root|items/([^/]+))', url)
+    if not match:
+        raise ValueError(f"Not a drive url: {url}")
+    return match.group(1), match.group(2)
+
+def _get_delta_pages(url: str, token: str):
+    """Follows the nextLink(s) of a delta query, yields each page"""
+    headers = {
+        'Accept': 'application/json',
+        "Authorization": f"Bearer {token}"
+    }
+    while url:
+        r = throttle.request("graph", "GET", url, session=_session, headers=headers, timeout=10)
+        if r.status_code == 410:
+            raise DeltaTokenExpiredError(r.text)
+        r.raise_for_status()
+        page = r.json()
+        yield page
+        url = page.get('@odata.nextLink')
+
+def get_drive_changes(drive_id: str, token: str, state: dict = None, folder_id: str = None, # pylint: disable=too-many-arguments,too-many-positional-arguments,too-many-locals
+                      known_ids: set[str] = None):
+    """
+    Query the delta of a drive, starting from the state of the previous run if any, else enumerate the whole drive.
+
+    Graph only supports delta on the root of a sharepoint drive, so when a folder_id is passed we keep track of
+    the folders under it (in the state) to only return files from that folder and its subfolders.
+
+    known_ids are the files in scope as of the previous run: only those are reported as deleted (or moved out of
+    the folder), the changes of the rest of the drive are none of this scope's business. When they are not known,
+    deleted items are reported if they were in a folder of the scope and moves out of the folder are missed (the
+    next full crawl syncs them).
+
+    Returns a dict {
+                'files': [file_info] for added/updated files,
+                'deleted': [ids] for removed files (or moved out of the folder),
+                'state': {'deltaLink': str, 'folders': [ids]} to save for the next run,
+                'full': True if the whole drive was enumerated
+            }
+    """
+    full = not state
+    fields = ','.join(DRIVE_ITEM_FIELDS + ['parentReference', 'deleted'])
+    url = state['deltaLink'] if state else f"{GRAPH_API_ENDPOINT}/drives/{drive_id}/root/delta?$select={fields}"
+    folders = set(state['folders']) if state else set()
+    if folder_id:
+        folders.add(folder_id)
+    files = {}
+    deleted = set()
+    delta_link = None
+    for page in _get_delta_pages(url, token):
+        # parents are always returned before their children in a delta page.
+        for item in page.get('value', []):
+            parent_id = item.get('parentReference', {}).get('id')
+            in_scope = not folder_id or parent_id in folders
+            was_indexed = item['id'] in known_ids if known_ids is not None else in_scope
+            if 'deleted' in item:
+                folders.discard(item['id'])
+                files.pop(item['id'], None)
+                if was_indexed:
+                    deleted.add(item['id'])
+            elif 'folder' in item:
+                if in_scope:
+                    folders.add(item['id'])
+                elif item['id'] != folder_id:
+                    folders.discard(item['id'])
+            elif 'file' in item and '@microsoft.graph.downloadUrl' in item:
+                if in_scope:
+                    files[item['id']] = file_info(item, drive_id)
+                    deleted.discard(item['id'])
+                elif not full and known_ids is not None and item['id'] in known_ids:
+                    # moved out of the folder we index
+                    deleted.add(item['id'])
+        delta_link = page.get('@odata.deltaLink', delta_link)
+    logger.info("Delta query for drive %s returned %s file(s) and %s deleted item(s)", drive_id, len(files),
+                len(deleted))
+    return {
+        'files': list(files.values()),
+        'deleted': list(deleted),
+        'state': {'deltaLink': delta_link, 'folders': list(folders)},
+        'full': full
+    }
 
 def get_drives_info(url: str, token: str, drives_info):
     """
@@ -41,7 +253,7 @@ def get_drives_info(url: str, token: str, drives_info):
     """
     # this is the base url, we will extend it with /items/{folder_id}/children (removing /root)
     # for each items in the list
-    result = call_graph_api(url, token, attribute_filter="folder")#, odata_filter="#microsoft.graph.drive")
+    result = call_graph_api(url, token, attribute_filter="folder", select=["id", "name", "folder"], top=PAGE_SIZE)
     new_url = url.rstrip("/root/children") # remove the root/children if present
     pattern = r'(/items).*'
     new_url = re.sub(pattern, r'\1', new_url).rstrip("/items")
@@ -87,31 +299,60 @@ def is_an_updated_document(index_name: str, document_name: str, last_updated: st
             logger.warning("Unable to format date, will skip this entry")
     return False
 
-def delete_document(index_name: str, document_name: str):
+def get_updated_files(index_name: str, files: list[dict]):
     """
-    Delete documents that match this name from the index passed in parameter
+    Bulk version of is_an_updated_document, compare the crawled files with what's in the index in a few queries.
 
-    Returns an List of updated (deleted) documents
+    Files are matched on their graph item id (the doc_id of the chunks), returns the files that are missing from
+    the index or that have a newer lastModifiedDateTime than their indexed chunks.
     """
-    search_client = get_search_client(index_name)
+    indexed = {}
+    for i in range(0, len(files), SEARCH_IN_BATCH_SIZE):
+        ids = ','.join(file['id'] for file in files[i:i + SEARCH_IN_BATCH_SIZE])
+        # the fields are not facetable, every chunk is read (1000 per request, see search_chunks).
+        results = search_chunks(index_name, f"search.in(doc_id, '{ids}', ',')", ["doc_id", "lastModifiedDateTime"])
+        for result in results:
+            # a document has many chunks, they all have the same date unless a previous update failed mid-way.
+            previous = indexed.get(result['doc_id'])
+            if previous is None or result['lastModifiedDateTime'] < previous:
+                indexed[result['doc_id']] = result['lastModifiedDateTime']
 
-    search_query = f"title eq '{escape_azure_search_special_chars(document_name)}'"
-    logger.info(search_query)
+    updated = []
+    for file in files:
+        if file['id'] not in indexed:
+            updated.append(file)
+            continue
+        try:
+            date_searched = dt.strptime(indexed[file['id']], "%Y-%m-%dT%H:%M:%SZ")
+            date_passed = dt.strptime(file['lastModifiedDateTime'], "%Y-%m-%dT%H:%M:%SZ")
+            if date_passed > date_searched:
+                updated.append(file)
+        except (TypeError, ValueError):
+            logger.warning("Unable to format date for %s, will (re)index it", file['title'])
+            updated.append(file)
+    logger.info("%s out of %s file(s) are new or updated in index %s", len(updated), len(files), index_name)
+    return updated
 
-    results = search_client.search(
-        search_text="*",  # Use wildcard to search for all documents
-        filter=search_query,
-        select=["title", "lastModifiedDateTime"]  # Specify the fields to retrieve
-    )
+def delete_document(index_name: str, document_name: str):
+    """
+    Delete the chunks of the documents that match this name (title) from the index passed in parameter
+
+    Returns the number of deleted chunks
+    """
+    return delete_chunks(index_name, f"title eq '{escape_azure_search_special_chars(document_name)}'")
 
-    if not results.get_count() is None:
-        # Extract document IDs
-        document_keys = [doc["id"] for doc in results]
-        # Delete documents
-        logger.info("Deleting those documents from the index: %s", document_keys)
-        batch = [{"@search.action": "delete", "id": key} for key in document_keys]
-        return search_client.upload_documents(documents=batch)
-    return []
+def delete_documents(index_name: str, document_ids: list[str]):
+    """
+    Delete all the chunks of the documents (graph item id stored as the doc_id) from the index passed in parameter
+
+    Returns the number of deleted chunks
+    """
+    deleted = 0
+    for i in range(0, len(document_ids), SEARCH_IN_BATCH_SIZE):
+        deleted += delete_chunks(index_name,
+                                 f"search.in(doc_id, '{','.join(document_ids[i:i + SEARCH_IN_BATCH_SIZE])}', ',')")
+    logger.info("Deleted %s chunk(s) for %s document(s) from index %s", deleted, len(document_ids), index_name)
+    return deleted
 
 def escape_azure_search_special_chars(s):
     """
@@ -0,0 +1,144 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import cache
+
+__all__ = ["STAGES", "VOLUMES", "Recorder", "merge_activity_metrics", "new_summary", "add_stage",
+           "add_activity_metrics", "add_run_summary"]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# stages of a run, the first four are timed by the orchestrator, the others by the index_files activity (copy being
+# the files indexed as a copy of an identical one)
+STAGES = ["site_lookup", "listing", "sync", "freshness", "download", "parse", "embed", "upload", "copy"]
+# volumes measured per file (and summed up for the run), `chunks` and `tokens` are the ones sent to the embedding
+# model, `cached` the chunks whose embedding was in the cache, `copied` the chunks copied instead of embedded and
+# `removed` the chunks deleted from the index (deleted files, orphans and previous versions of updated files)
+VOLUMES = ["bytes", "documents", "chunks", "tokens", "cached", "copied", "removed", "requests", "throttled",
+           "retries", "wait_seconds"]
+
+# none, otel (to the globally configured meter provider) or azure_monitor (App Insights, configured here from
+# APPLICATIONINSIGHTS_CONNECTION_STRING), the exporter packages are optional.
+metrics_exporter: str = os.getenv("METRICS_EXPORTER", "none").lower()
+
+@cache
+def _instruments():
+    """OpenTelemetry instruments, None if the export is disabled or opentelemetry is not installed"""
+    if metrics_exporter not in ("otel", "azure_monitor"):
+        return None
+    try:
+        # pylint: disable=import-outside-toplevel
+        from opentelemetry import metrics
+        if metrics_exporter == "azure_monitor":
+            from azure.monitor.opentelemetry import configure_azure_monitor
+            configure_azure_monitor()
+    except ImportError as e:
+        logger.warning("Unable to export the metrics (%s), install opentelemetry/azure-monitor-opentelemetry", e)
+        return None
+    meter = metrics.get_meter("sharepoint_indexer")
+    instruments = {"seconds": meter.create_histogram("indexer.stage.duration", unit="s",
+                                                     description="Duration of a stage for a file or a batch")}
+    for volume in VOLUMES:
+        instruments[volume] = meter.create_counter(f"indexer.{volume}", description=f"{volume} per stage")
+    return instruments
+
+def _export(stage: str, measure: str, value: float):
+    instruments = _instruments()
+    if instruments and measure in instruments:
+        if measure == "seconds":
+            instruments[measure].record(value, {"stage": stage})
+        else:
+            instruments[measure].add(value, {"stage": stage})
+
+class Recorder:
+    """
+    Collects the measures of an activity: `files` by file id ({'download_seconds': .., 'bytes': .., ...}) and
+    `stages` ({stage: {'seconds': .., 'count': ..}}) for the whole activity. Thread safe.
+    """
+    def __init__(self):
+        self.files = defaultdict(lambda: defaultdict(float))
+        self.stages = defaultdict(lambda: {"seconds": 0.0, "count": 0})
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, stage: str, file_id: str = None):
+        """Time the block as (part of) a stage, for a file if file_id is passed"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.stages[stage]["seconds"] += elapsed
+                self.stages[stage]["count"] += 1
+                if file_id:
+                    self.files[file_id][f"{stage}_seconds"] += elapsed
+            _export(stage, "seconds", elapsed)
+
+    def add(self, stage: str, measure: str, value: float, file_id: str = None):
+        """Add to a volume (bytes, chunks...) of a stage, for a file if file_id is passed"""
+        with self._lock:
+            self.stages[stage][measure] = self.stages[stage].get(measure, 0) + value
+            if file_id:
+                self.files[file_id][measure] += value
+        _export(stage, measure, value)
+
+    def add_throttling(self, stage: str, counters: dict, file_id: str = None):
+        """Add the counters of a throttle.track() block (all services)"""
+        for service_counters in counters.values():
+            for measure, value in service_counters.items():
+                if value:
+                    self.add(stage, measure, value, file_id)
+
+    def to_dict(self):
+        """json friendly version, returned by the activity"""
+        with self._lock:
+            return {"files": {file_id: {k: round(v, 4) for k, v in measures.items()}
+                              for file_id, measures in self.files.items()},
+                    "stages": {stage: {k: round(v, 4) for k, v in measures.items()}
+                               for stage, measures in self.stages.items()}}
+
+# NOTE: the functions below are called by the orchestrators, they need to stay deterministic (no clock, no I/O).
+
+def merge_activity_metrics(into: dict, other: dict):
+    """Merge the metrics of an activity (Recorder.to_dict) into the ones of another"""
+    if "files" in other:
+        into.setdefault("files", {}).update(other["files"])
+    for stage, measures in other.get("stages", {}).items():
+        totals = into.setdefault("stages", {}).setdefault(stage, {})
+        for measure, value in measures.items():
+            totals[measure] = round(totals.get(measure, 0) + value, 4)
+    return into
+
+def new_summary():
+    """Empty run summary, see add_stage and add_activity_metrics"""
+    return {"stages": {stage: {"seconds": 0.0, "count": 0} for stage in STAGES},
+            "totals": {volume: 0 for volume in VOLUMES}}
+
+def add_stage(summary: dict, stage: str, seconds: float, count: int = 1):
+    """Add a stage timed by the orchestrator"""
+    summary["stages"][stage]["seconds"] = round(summary["stages"][stage]["seconds"] + seconds, 4)
+    summary["stages"][stage]["count"] += count
+    return summary
+
+def add_activity_metrics(summary: dict, metrics: dict):
+    """Roll up the metrics returned by an activity (Recorder.to_dict, the files excepted) into the run summary"""
+    merge_activity_metrics(summary, {"stages": metrics.get("stages", {})})
+    for measures in metrics.get("stages", {}).values():
+        for measure, value in measures.items():
+            if measure in summary["totals"]:
+                summary["totals"][measure] = round(summary["totals"][measure] + value, 4)
+    return summary
+
+def add_run_summary(summary: dict, other: dict):
+    """Roll up the summary of a run (output of start) into the combined one of a batch of runs"""
+    merge_activity_metrics(summary, {"stages": other.get("stages", {})})
+    for measure, value in other.get("totals", {}).items():
+        summary["totals"][measure] = round(summary["totals"].get(measure, 0) + value, 4)
+    for key, count in other.get("files", {}).items():
+        summary.setdefault("files", {})[key] = summary.get("files", {}).get(key, 0) + count
+    return summary
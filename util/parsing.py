@@ -0,0 +1,136 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from . import azure
+from .download import FILE_UNDERSCORE
+
+__all__ = ["FileTooLargeError", "file_metadata", "check_size", "parse_file"]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# CPU heavy formats are parsed in a pool of processes so they don't block the other activities of the worker.
+parse_workers: int          = int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+parse_timeout: int          = int(os.getenv("PARSE_TIMEOUT", "300"))
+parse_memory_limit_mb: int  = int(os.getenv("PARSE_MEMORY_LIMIT_MB", "2048"))
+# files bigger than this are not parsed at all
+parse_max_size: int         = int(os.getenv("PARSE_MAX_SIZE", str(200 * 1024 * 1024)))
+
+# formats that are simply decoded, no need for a reader (nor a process) for those.
+TEXT_EXTENSIONS = {".txt", ".md", ".csv", ".json", ".xml", ".html", ".htm", ".log", ".yaml", ".yml"}
+
+# the process pool of the worker, replaced when it gets restarted (like the clients cached in util/azure.py)
+_pool = {"executor": None}
+_executor_lock = threading.Lock()
+
+class FileTooLargeError(Exception):
+    """Raised for files over `parse_max_size`, those are skipped"""
+
+def file_metadata(filename: str):
+    """pre-populate metadata with filename for later."""
+    metadata = azure.METADATA_FIELDS.copy()
+    # process the filename to remove the folders (if any)
+    basename = os.path.basename(filename)
+    metadata['title'] = basename.split(FILE_UNDERSCORE)[1]
+    return metadata
+
+def _limit_memory():
+    """Pool process initializer, caps the address space so a bad file can't take the whole instance down"""
+    if parse_memory_limit_mb <= 0:
+        return
+    try:
+        import resource # pylint: disable=import-outside-toplevel
+        limit = parse_memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning("Unable to limit the memory of the parsing process: %s", e)
+
+def _parse(path: str, data: bytes = None):
+    """Runs in the pool: parse a file from its bytes (or from its path on disk when data is None)"""
+    # pylint: disable=import-outside-toplevel
+    from llama_index.core import SimpleDirectoryReader
+    fs = None
+    if data is not None:
+        from fsspec.implementations.memory import MemoryFileSystem
+        fs = MemoryFileSystem()
+        fs.pipe(path, data)
+    try:
+        return SimpleDirectoryReader(input_files=[path], fs=fs, file_metadata=file_metadata).load_data()
+    finally:
+        if fs is not None:
+            fs.rm(path)
+
+def _get_executor():
+    with _executor_lock:
+        if _pool["executor"] is None:
+            # spawn rather than fork, the host process has threads (grpc, http pools) that don't survive a fork.
+            _pool["executor"] = ProcessPoolExecutor(max_workers=parse_workers,
+                                                    mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=_limit_memory)
+        return _pool["executor"]
+
+def _reset_executor(executor: ProcessPoolExecutor):
+    """Kill the pool (i.e. a worker is stuck on a file), a new one is started on the next parse"""
+    with _executor_lock:
+        if _pool["executor"] is not executor:
+            # already restarted because of another file
+            return
+        _pool["executor"] = None
+    for process in list(executor._processes.values()): # pylint: disable=protected-access
+        process.terminate()
+    executor.shutdown(wait=False, cancel_futures=True)
+
+def _parse_in_pool(path: str, data: bytes = None):
+    """Parse a file in the process pool, restarting the pool if the file got a process stuck or killed"""
+    executor = _get_executor()
+    future = executor.submit(_parse, path, data)
+    try:
+        return future.result(timeout=parse_timeout)
+    except FutureTimeoutError as e:
+        logger.error("Parsing %s took more than %ss, restarting the parsing processes", path, parse_timeout)
+        _reset_executor(executor)
+        raise TimeoutError(f"Parsing took more than {parse_timeout}s") from e
+    except BrokenProcessPool:
+        logger.error("Parsing process died while parsing %s (memory limit?)", path)
+        _reset_executor(executor)
+        raise
+
+def check_size(name: str, size: int):
+    """Raises FileTooLargeError for a file over `parse_max_size` (i.e. before downloading it)"""
+    if (size or 0) > parse_max_size:
+        raise FileTooLargeError(f"File {name} is too large to be parsed ({size} bytes), skipped")
+
+def parse_file(path: str, fs=None):
+    """
+    Parse a downloaded file into llama_index documents (metadata as per file_metadata).
+
+    fs is the fsspec filesystem holding the file, None for the local one. Text formats are decoded in process,
+    everything else is parsed in the process pool with a `parse_timeout` timeout.
+    """
+    # pylint: disable=import-outside-toplevel
+    from llama_index.core.schema import Document
+
+    # the graph listing size is checked before the download already, it may be missing or wrong though.
+    check_size(os.path.basename(path), fs.size(path) if fs else os.path.getsize(path))
+
+    if os.path.splitext(path)[1].lower() in TEXT_EXTENSIONS:
+        if fs:
+            data = fs.cat(path)
+        else:
+            with open(path, 'rb') as f:
+                data = f.read()
+        return [Document(text=data.decode('utf-8', errors='replace'), metadata=file_metadata(path))]
+
+    data = fs.cat(path) if fs else None
+    try:
+        return _parse_in_pool(path, data)
+    except (BrokenProcessPool, CancelledError):
+        # all the files being parsed (or queued) fail when a process dies or the pool is restarted because of
+        # another file, parse it once more before reporting it as failed.
+        logger.warning("Parsing processes restarted while parsing %s, parsing it again", path)
+        return _parse_in_pool(path, data)
@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+import os
+from functools import cache
+
+from azure.core.exceptions import ResourceNotFoundError
+
+__all__ = ["MANIFEST_PAGE_SIZE", "get_delta_state", "save_delta_state", "commit_delta_state", "save_manifest",
+           "get_manifest_page", "save_manifest_page", "manifest_prefix", "delete_manifest", "get_dedupe_entry",
+           "save_dedupe_entry", "delete_dedupe_entry", "get_scope_ids", "save_scope_ids", "get_index_ids"]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+blob_connection_string: str = os.getenv("BLOB_CONNECTION_STRING", "UNDEFINED")
+blob_container_name: str    = os.getenv("BLOB_CONTAINER_NAME", "sharepoint-az-func")
+
+_DELTA_FOLDER = "delta"
+_MANIFEST_FOLDER = "manifests"
+_DEDUPE_FOLDER = "dedupe"
+_SCOPES_FOLDER = "scopes"
+# files per manifest page, the orchestrator handles a page at a time (see start in function_app)
+MANIFEST_PAGE_SIZE: int = int(os.getenv("MANIFEST_PAGE_SIZE", "1000"))
+
+@cache
+def _get_container_client():
+    """
+    Returns the (shared) container client of the storage account used by the function app, its connections are
+    reused by every manifest, scope, delta and dedupe call of the worker.
+    """
+    from azure.storage.blob import BlobServiceClient # pylint: disable=import-outside-toplevel
+    return BlobServiceClient.from_connection_string(blob_connection_string).get_container_client(blob_container_name)
+
+def _url_hash(url: str):
+    return hashlib.sha1(url.encode()).hexdigest()
+
+def _delta_blob_name(site_name: str, url: str, run_id: str = ""):
+    """
+    Name of the blob holding the delta state of a scope (drive or folder url) of a site, or the pending state of a
+    run if run_id is passed. Each folder of a drive has its own delta link and folders.
+    """
+    name = f"{_DELTA_FOLDER}/{site_name.lower()}/{_url_hash(url)}"
+    return f"{name}.{run_id}.pending.json" if run_id else f"{name}.json"
+
+def get_delta_state(site_name: str, url: str):
+    """
+    Get the last committed delta state for a site and a scope (drive or folder url).
+
+    Returns None if there is no state saved yet, else a dict {'deltaLink': str, 'folders': [str]}
+    """
+    try:
+        blob = _get_container_client().download_blob(_delta_blob_name(site_name, url))
+        return json.loads(blob.readall())
+    except ResourceNotFoundError:
+        logger.info("No delta state found for site %s and scope %s", site_name, url)
+        return None
+
+def save_delta_state(site_name: str, url: str, run_id: str, state: dict):
+    """
+    Saves the delta state as pending for the run, it only becomes the current one once committed
+    (so that a run failing mid-way is not skipping changes on the next one).
+    """
+    _get_container_client().upload_blob(_delta_blob_name(site_name, url, run_id),
+                                        json.dumps(state),
+                                        overwrite=True)
+
+def commit_delta_state(site_name: str, url: str, run_id: str):
+    """Promote the pending delta state of a run as the current one for the site and scope"""
+    container = _get_container_client()
+    pending = container.get_blob_client(_delta_blob_name(site_name, url, run_id))
+    try:
+        state = pending.download_blob().readall()
+    except ResourceNotFoundError:
+        logger.warning("No pending delta state for site %s, scope %s and run %s", site_name, url, run_id)
+        return False
+    container.upload_blob(_delta_blob_name(site_name, url), state, overwrite=True)
+    pending.delete_blob()
+    return True
+
+def manifest_prefix(run_id: str, kind: str = ""):
+    """Prefix of the blobs of the manifest of a run (or of one kind of pages: files, deleted, results)"""
+    return f"{_MANIFEST_FOLDER}/{run_id}/{kind + '/' if kind else ''}"
+
+def _manifest_blob_name(run_id: str, kind: str, page: int):
+    return f"{manifest_prefix(run_id, kind)}{page:06d}.json"
+
+def save_manifest_page(run_id: str, kind: str, page: int, items: list):
+    """Save (or replace) a page of the manifest of a run"""
+    _get_container_client().upload_blob(_manifest_blob_name(run_id, kind, page), json.dumps(items), overwrite=True)
+
+def save_manifest(run_id: str, kind: str, items: list, page_size: int = MANIFEST_PAGE_SIZE):
+    """
+    Save a list (crawled files, deleted ids...) of a run in pages of `page_size` items, so that only the run id and
+    page numbers go through the orchestrations. Returns the number of pages.
+    """
+    pages = 0
+    for pages, i in enumerate(range(0, len(items), page_size), start=1):
+        save_manifest_page(run_id, kind, pages - 1, items[i:i + page_size])
+    return pages
+
+def get_manifest_page(run_id: str, kind: str, page: int):
+    """Items of a page of the manifest of a run"""
+    return json.loads(_get_container_client().download_blob(_manifest_blob_name(run_id, kind, page)).readall())
+
+def delete_manifest(run_id: str, kinds: list[str]):
+    """Remove these kinds of pages from the manifest of a run"""
+    container = _get_container_client()
+    for kind in kinds:
+        names = list(container.list_blob_names(name_starts_with=manifest_prefix(run_id, kind)))
+        # delete_blobs is a batch of up to 256 blobs
+        for i in range(0, len(names), 256):
+            container.delete_blobs(*names[i:i + 256])
+
+def _dedupe_blob_name(key: str):
+    return f"{_DEDUPE_FOLDER}/{key}.json"
+
+def get_dedupe_entry(key: str):
+    """Where the content of this key is indexed ({'index', 'doc_id', 'chunk_ids'}), None if it isn't yet"""
+    try:
+        return json.loads(_get_container_client().download_blob(_dedupe_blob_name(key)).readall())
+    except ResourceNotFoundError:
+        return None
+
+def save_dedupe_entry(key: str, entry: dict):
+    """Save (or replace) where the content of this key is indexed"""
+    _get_container_client().upload_blob(_dedupe_blob_name(key), json.dumps(entry), overwrite=True)
+
+def delete_dedupe_entry(key: str):
+    """Forget where the content of this key is indexed (i.e. the document was deleted from the index)"""
+    try:
+        _get_container_client().get_blob_client(_dedupe_blob_name(key)).delete_blob()
+    except ResourceNotFoundError:
+        pass
+
+def _scope_blob_name(index_name: str, url: str):
+    return f"{_SCOPES_FOLDER}/{index_name.lower()}/{_url_hash(url)}.json"
+
+def get_scope_ids(index_name: str, url: str):
+    """
+    Ids of the files of a scope (drive or folder url) indexed into an index, as of its last crawl. None if the
+    scope was never fully crawled.
+    """
+    try:
+        return json.loads(_get_container_client().download_blob(_scope_blob_name(index_name, url)).readall())['ids']
+    except ResourceNotFoundError:
+        return None
+
+def save_scope_ids(index_name: str, url: str, ids: list[str]):
+    """Save the ids of the files of a scope indexed into an index"""
+    _get_container_client().upload_blob(_scope_blob_name(index_name, url), json.dumps({'url': url, 'ids': ids}),
+                                        overwrite=True)
+
+def get_index_ids(index_name: str):
+    """Ids of the files of all the scopes indexed into an index (several drives/folders can share a site index)"""
+    container = _get_container_client()
+    ids = set()
+    for name in container.list_blob_names(name_starts_with=f"{_SCOPES_FOLDER}/{index_name.lower()}/"):
+        ids.update(json.loads(container.download_blob(name).readall())['ids'])
+    return ids
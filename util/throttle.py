@@ -0,0 +1,256 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+import requests
+
+__all__ = ["TokenBucket",
+           "get_bucket",
+           "acquire",
+           "observe",
+           "request",
+           "stats",
+           "track",
+           "search_policy",
+           "openai_http_client"]
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Every outbound call goes through a token bucket per service (graph, download, search, openai). The rate of a
+# bucket starts at its max, is halved each time the service throttles us (429/503) and slowly grows back on
+# successful calls, a Retry-After pauses the whole bucket (i.e. every thread of the worker calling that service).
+# Rates are per worker process, in requests per second.
+MAX_RATES = {
+    "graph": float(os.getenv("THROTTLE_GRAPH_RATE", "50")),
+    "download": float(os.getenv("THROTTLE_DOWNLOAD_RATE", "50")),
+    "search": float(os.getenv("THROTTLE_SEARCH_RATE", "20")),
+    "openai": float(os.getenv("THROTTLE_OPENAI_RATE", "10")),
+}
+max_retries: int = int(os.getenv("THROTTLE_MAX_RETRIES", "6"))
+# backoff of the retries without a Retry-After header: base * 2^attempt (jittered), capped
+backoff_base: float = float(os.getenv("THROTTLE_BACKOFF_BASE", "0.5"))
+backoff_max: float = float(os.getenv("THROTTLE_BACKOFF_MAX", "60"))
+
+THROTTLED_STATUS = {429, 503}
+RETRIED_STATUS = THROTTLED_STATUS | {500, 502, 504}
+_MIN_RATE = 0.1
+
+# counters of the calls made by a thread within a `track` block
+_local = threading.local()
+
+def _track(service: str, counter: str, value: float = 1):
+    counters = getattr(_local, "counters", None)
+    if counters is not None:
+        counters[service][counter] += value
+
+class TokenBucket: # pylint: disable=too-many-instance-attributes
+    """
+    Adaptive token bucket, acquire() blocks until a request can be sent.
+
+    The counters (requests, throttled, retries, wait_seconds) are what to look at when tuning the concurrency:
+    a high wait_seconds means the service (or our max rate) is the bottleneck, not the number of workers.
+    """
+    def __init__(self, name: str, max_rate: float):
+        self.name = name
+        self.max_rate = max(max_rate, _MIN_RATE)
+        self.rate = self.max_rate
+        self._tokens = self.max_rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.retries = 0
+        self.wait_seconds = 0.0
+
+    def _delay(self, now: float):
+        """Seconds to wait before the next request can go (takes the token if none), called with the lock held"""
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        delay = max(0.0, self._paused_until - now)
+        if delay == 0 and self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return max(delay, (1 - self._tokens) / self.rate)
+
+    def acquire(self):
+        """Wait for a token, returns how long it waited (in seconds)"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                delay = self._delay(time.monotonic())
+                if delay == 0:
+                    self.requests += 1
+                    self.wait_seconds += waited
+                    break
+            time.sleep(delay)
+            waited += delay
+        _track(self.name, "requests")
+        _track(self.name, "wait_seconds", waited)
+        return waited
+
+    def throttle(self, delay: float = None):
+        """The service throttled us: halve the rate and pause the bucket for delay seconds (if any)"""
+        _track(self.name, "throttled")
+        with self._lock:
+            self.throttled += 1
+            self.rate = max(_MIN_RATE, self.rate / 2)
+            self._tokens = min(self._tokens, 0)
+            if delay:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logger.warning("%s is throttling, rate lowered to %.2f/s (retry after %ss)", self.name, self.rate, delay)
+
+    def success(self):
+        """Additive increase, the rate grows back by 1/s every ~rate successful requests"""
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 1 / self.rate)
+
+    def retried(self, delay: float):
+        """Count a retry and the time spent backing off before it"""
+        with self._lock:
+            self.retries += 1
+            self.wait_seconds += delay
+        _track(self.name, "retries")
+        _track(self.name, "wait_seconds", delay)
+
+    def stats(self):
+        """Returns the counters and the current rate of the bucket"""
+        with self._lock:
+            return {"requests": self.requests,
+                    "throttled": self.throttled,
+                    "retries": self.retries,
+                    "wait_seconds": round(self.wait_seconds, 3),
+                    "rate": round(self.rate, 2)}
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_bucket(service: str):
+    """Returns the (process wide) bucket of a service"""
+    with _buckets_lock:
+        if service not in _buckets:
+            _buckets[service] = TokenBucket(service, MAX_RATES.get(service, MAX_RATES["graph"]))
+        return _buckets[service]
+
+def acquire(service: str):
+    """Wait for the bucket of the service, returns the time waited"""
+    return get_bucket(service).acquire()
+
+def retry_after(headers) -> float:
+    """
+    Seconds to wait as per the throttling headers of a response (Retry-After in seconds or as a date,
+    retry-after-ms and x-ms-retry-after-ms), None if there are none.
+    """
+    for header, scale in (("retry-after-ms", 1000), ("x-ms-retry-after-ms", 1000)):
+        value = headers.get(header)
+        if value:
+            try:
+                return float(value) / scale
+            except ValueError:
+                pass
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def observe(service: str, status_code: int, headers):
+    """Adjust the bucket of the service from a response, returns the Retry-After (if it was throttled)"""
+    bucket = get_bucket(service)
+    if status_code in THROTTLED_STATUS:
+        delay = retry_after(headers)
+        bucket.throttle(delay)
+        return delay
+    if status_code < 500:
+        bucket.success()
+    return None
+
+def _backoff(attempt: int, delay: float = None):
+    """Full jitter exponential backoff, never shorter than what the service asked for"""
+    return max(delay or 0.0, random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt)))
+
+def request(service: str, method: str, url: str, session: requests.Session = None, **kwargs):
+    """
+    Send a request through the bucket of the service with requests, retried (jittered backoff) on throttling,
+    5xx and connection errors up to `max_retries` times.
+
+    Returns the last response, it is up to the caller to raise_for_status.
+    """
+    bucket = get_bucket(service)
+    send = (session or requests).request
+    attempt = 0
+    while True:
+        bucket.acquire()
+        try:
+            response = send(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= max_retries:
+                raise
+            delay = _backoff(attempt)
+            logger.warning("%s request failed (%s), retrying in %.1fs", service, e, delay)
+        else:
+            delay = observe(service, response.status_code, response.headers)
+            if response.status_code not in RETRIED_STATUS or attempt >= max_retries:
+                return response
+            delay = _backoff(attempt, delay)
+            logger.warning("%s returned %s, retrying in %.1fs", service, response.status_code, delay)
+            response.close()
+        bucket.retried(delay)
+        time.sleep(delay)
+        attempt += 1
+
+def stats():
+    """Returns the counters of every service called so far by this worker"""
+    with _buckets_lock:
+        buckets = list(_buckets.values())
+    return {bucket.name: bucket.stats() for bucket in buckets}
+
+@contextmanager
+def track():
+    """
+    Counts the calls made by the current thread within the block (the process wide counters are shared by all the
+    activities running at once), yields {service: {'requests', 'throttled', 'retries', 'wait_seconds'}}.
+    """
+    previous = getattr(_local, "counters", None)
+    _local.counters = defaultdict(lambda: {"requests": 0, "throttled": 0, "retries": 0, "wait_seconds": 0.0})
+    try:
+        yield _local.counters
+    finally:
+        _local.counters = previous
+
+def search_policy():
+    """
+    azure-core pipeline policy for the search clients (pass it as a per retry policy): the sdk retry policy
+    already retries throttled calls honoring Retry-After, this makes them go through the search bucket.
+    """
+    from azure.core.pipeline.policies import SansIOHTTPPolicy # pylint: disable=import-outside-toplevel
+
+    class _SearchThrottlePolicy(SansIOHTTPPolicy):
+        def on_request(self, request): # pylint: disable=redefined-outer-name
+            acquire("search")
+
+        def on_response(self, request, response): # pylint: disable=redefined-outer-name
+            observe("search", response.http_response.status_code, response.http_response.headers)
+
+    return _SearchThrottlePolicy()
+
+def openai_http_client():
+    """httpx client for the openai sdk (which does its own retries) so every attempt goes through the openai bucket"""
+    import httpx # pylint: disable=import-outside-toplevel
+    return httpx.Client(event_hooks={
+        "request": [lambda _: acquire("openai")],
+        "response": [lambda response: observe("openai", response.status_code, response.headers)],
+    })